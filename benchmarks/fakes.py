@@ -0,0 +1,231 @@
+"""
+Local stand-ins for Ring, LandingLens and Snowflake, so the pipeline in `nestcam.core` runs without any account:
+a Ring camera serving synthetic MP4s, a predictor with a configurable latency, and a Snowflake pool whose cursor
+understands the statements `nestcam.snowflake_utils` sends (PUT, DELETE, multi-row INSERT, COPY INTO) on top of
+SQLite and a directory per stage.
+"""
+
+import asyncio
+import gzip
+import json
+import re
+import shutil
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+from synthetic import make_synthetic_video
+
+from nestcam.snowflake_utils import INFERENCE_COLUMNS
+
+
+class FakeRingDevice:
+    """A stickup cam with `n_events` recent motion events, each recording a copy of the same synthetic clip."""
+
+    def __init__(self, clip_path: str, n_events: int, download_latency: float = 0.0, name: str = "Front Door"):
+        self.id = 1
+        self.name = name
+        self.clip_path = clip_path
+        self.download_latency = download_latency
+        now = datetime.now(timezone.utc)
+        # Newest first, like the Ring API; ids grow with time
+        self.history = [
+            {"id": 1000 + i, "kind": "motion", "created_at": now - timedelta(seconds=30 * (n_events - i))}
+            for i in reversed(range(n_events))
+        ]
+
+    async def async_history(self, limit: int = 30, older_than=None):
+        events = [event for event in self.history if older_than is None or event["id"] < int(older_than)]
+        return events[:limit]
+
+    async def async_recording_download(self, recording_id, filename, override=False):
+        await asyncio.sleep(self.download_latency)
+        await asyncio.to_thread(shutil.copy, self.clip_path, filename)
+
+    async def async_recording_url(self, recording_id):
+        await asyncio.sleep(self.download_latency)
+        return self.clip_path
+
+
+class FakeRing:
+    def __init__(self, device: FakeRingDevice):
+        self.device = device
+
+    def devices(self):
+        return {"stickup_cams": [self.device]}
+
+
+class FakeRingClient:
+    """Same surface as `nestcam.capture.ring_client.RingClient`; `device` is set by the harness before a run."""
+
+    device = None
+
+    def __init__(self, ring):
+        self.ring = ring
+
+    @classmethod
+    async def connect(cls):
+        return cls(FakeRing(cls.device))
+
+    def devices(self):
+        return self.ring.devices()
+
+    async def close(self):
+        pass
+
+
+class FakePrediction:
+    def __init__(self, index: int):
+        self.label_name = "robin"
+        self.label_index = 1
+        self.score = 0.9
+        self.bboxes = (10, 10, 50, 50)
+        self.id = f"prediction-{index}"
+
+
+class FakePredictor:
+    """LandingLens predictor that takes `latency` seconds per image and finds one robin."""
+
+    _endpoint_id = "fake-endpoint"
+
+    def __init__(self, latency: float = 0.2):
+        self.latency = latency
+        self._calls = 0
+
+    def predict(self, image):
+        time.sleep(self.latency)
+        self._calls += 1
+        return [FakePrediction(self._calls)]
+
+
+class LocalCursor:
+    """The subset of a Snowflake cursor `nestcam.snowflake_utils` uses, backed by SQLite and stage directories."""
+
+    def __init__(self, warehouse: "LocalSnowflake"):
+        self.warehouse = warehouse
+        self.description = None
+        self._rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _result(self, columns, rows):
+        self.description = [(column,) for column in columns]
+        self._rows = rows
+
+    def execute(self, query: str, params=None, file_stream=None):
+        query = query.strip()
+        with self.warehouse.lock:
+            if query.startswith("PUT"):
+                self._put(query, file_stream)
+            elif query.startswith("COPY INTO"):
+                self._copy(query)
+            elif query.startswith("INSERT INTO"):
+                self._insert(query, params or [])
+            elif query.startswith("DELETE FROM"):
+                self._delete(query, params or [])
+            else:
+                cursor = self.warehouse.db.execute(query, params or [])
+                self._result([desc[0] for desc in cursor.description or []], cursor.fetchall())
+        return self
+
+    def _put(self, query, file_stream):
+        source, stage = re.match(r"PUT '?file://(.+?)'? @(\S+)", query).groups()
+        stage_dir = self.warehouse.stage_dir(stage)
+        compress = "AUTO_COMPRESS=TRUE" in query
+        if file_stream is not None:
+            sources = [(Path(source).name, file_stream.read())]
+        else:
+            paths = Path(source).parent.glob(Path(source).name) if "*" in source else [Path(source)]
+            sources = [(path.name, path.read_bytes()) for path in paths]
+        rows = []
+        for name, data in sources:
+            target = name + ".gz" if compress else name
+            (stage_dir / target).write_bytes(gzip.compress(data) if compress else data)
+            self.warehouse.put_bytes += len(data)
+            rows.append((name, target, "UPLOADED"))
+        self._result(["source", "target", "status"], rows)
+
+    def _copy(self, query):
+        table, stage, files = re.match(r"COPY INTO (\S+) FROM (\S+) FILES = \('(.+?)'\)", query).groups()
+        path = self.warehouse.stage_dir(stage[1:]) / files
+        records = [json.loads(line) for line in gzip.decompress(path.read_bytes()).decode().splitlines() if line]
+        self._write(table, [[record.get(column) for column in INFERENCE_COLUMNS] for record in records])
+        path.unlink()  # PURGE = TRUE
+        self._result(["file", "status", "rows_parsed", "rows_loaded"], [(files, "LOADED", len(records), len(records))])
+
+    def _insert(self, query, params):
+        table, columns = re.match(r"INSERT INTO (\S+) \((.+?)\)", query).groups()
+        width = len(columns.split(","))
+        self._write(table, [params[i : i + width] for i in range(0, len(params), width)])
+        self._result(["number of rows inserted"], [(len(params) // width,)])
+
+    def _delete(self, query, params):
+        table = re.match(r"DELETE FROM (\S+)", query).group(1)
+        query = query.replace(table, self.warehouse.table(table), 1).replace("%s", "?")
+        deleted = self.warehouse.db.execute(query, params).rowcount
+        self.warehouse.db.commit()
+        self._result(["number of rows deleted"], [(deleted,)])
+
+    def _write(self, table, rows):
+        placeholders = ", ".join(["?"] * len(INFERENCE_COLUMNS))
+        values = [[json.dumps(value) if isinstance(value, list) else value for value in row] for row in rows]
+        self.warehouse.db.executemany(f"INSERT INTO {self.warehouse.table(table)} VALUES ({placeholders})", values)
+        self.warehouse.db.commit()
+
+    def fetchall(self):
+        return self._rows
+
+    def fetchone(self):
+        return self._rows[0] if self._rows else None
+
+    def close(self):
+        pass
+
+
+class LocalSnowflake:
+    """
+    Drop-in for `nestcam.snowflake_utils.SnowflakePool`: the inference table is a SQLite table and every stage a
+    directory under `root`. Counts what was written so a benchmark can check nothing was lost.
+    """
+
+    root = None  # set by the harness before a run
+
+    def __init__(self, *args, **kwargs):
+        self.root = Path(self.root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.root / "warehouse.sqlite", check_same_thread=False)
+        self.put_bytes = 0
+        self._tables = set()
+
+    def table(self, name):
+        name = name.split(".")[-1].replace("%", "")
+        if name not in self._tables:
+            self.db.execute(f"CREATE TABLE IF NOT EXISTS {name} ({', '.join(INFERENCE_COLUMNS)})")
+            self._tables.add(name)
+        return name
+
+    def stage_dir(self, stage):
+        stage_dir = self.root / "stages" / stage.replace("%", "table_").replace(".", "_")
+        stage_dir.mkdir(parents=True, exist_ok=True)
+        return stage_dir
+
+    def run(self, func, *args, **kwargs):
+        return func(LocalCursor(self), *args, **kwargs)
+
+    async def run_async(self, func, *args, **kwargs):
+        return await asyncio.to_thread(self.run, func, *args, **kwargs)
+
+    def close(self):
+        self.db.close()
+
+
+def make_clip(directory: str, seconds: float, fps: float, size: tuple):
+    """The synthetic recording every fake event serves."""
+    return make_synthetic_video(str(Path(directory) / f"clip_{seconds:g}s.mp4"), seconds, fps, size)
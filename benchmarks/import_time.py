@@ -0,0 +1,63 @@
+"""
+Import cost of the modules each CLI command loads, from `python -X importtime`, checked against a budget so short
+cron runs (e.g. `nestcam collect-data` every few minutes) stay cheap. Exits with status 1 when a command is over its
+budget or imports a backend it doesn't use.
+
+    python benchmarks/import_time.py --repeat 5 --top 10
+"""
+
+import argparse
+import subprocess
+import sys
+
+# Modules loaded before a command does any work, the budget for them (ms) and backends it must not import
+COMMANDS = {
+    "--help / stats": (["nestcam.cli", "nestcam.config", "nestcam.metrics"], 300, ["landingai", "snowflake", "cv2"]),
+    "collect-data": (["nestcam.cli", "nestcam.core"], 2000, ["landingai", "PIL"]),
+    "process-events": (["nestcam.cli", "nestcam.core", "landingai.predict"], 2500, []),
+}
+
+
+def import_times(modules):
+    """{module: cumulative microseconds} for a fresh interpreter importing `modules`."""
+    code = "; ".join(f"import {module}" for module in modules)
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True, check=True
+    ).stderr
+    times = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        # Only top-level entries add up to the total; nested ones are already included in their parent
+        times.setdefault(name.strip(), (int(cumulative), not name[1:].startswith(" ")))
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per command; the fastest one counts")
+    parser.add_argument("--top", type=int, default=5, help="Slowest top-level imports to list per command")
+    parser.add_argument("--scale", type=float, default=1.0, help="Multiply the budgets, e.g. for a slow machine")
+    args = parser.parse_args()
+
+    failed = False
+    for command, (modules, budget_ms, forbidden) in COMMANDS.items():
+        runs = [import_times(modules) for _ in range(args.repeat)]
+        totals = [sum(us for us, top_level in run.values() if top_level) / 1000 for run in runs]
+        fastest = runs[totals.index(min(totals))]
+        budget_ms *= args.scale
+        loaded = [name for name in forbidden if name in fastest]
+        ok = min(totals) <= budget_ms and not loaded
+        failed |= not ok
+        print(f"{command}: {min(totals):.0f} ms (budget {budget_ms:.0f} ms) {'ok' if ok else 'FAIL'}")
+        if loaded:
+            print(f"  imports {', '.join(loaded)}, which this command doesn't use")
+        top_level = sorted(((us, name) for name, (us, top) in fastest.items() if top), reverse=True)
+        for us, name in top_level[: args.top]:
+            print(f"  {us / 1000:8.1f} ms  {name}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
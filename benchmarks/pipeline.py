@@ -0,0 +1,149 @@
+"""
+End-to-end throughput of `collect_data_last_minutes` and `process_events_last_minutes` without any account: Ring,
+LandingLens and Snowflake are replaced by the local stand-ins in fakes.py. Runs every combination of clip length and
+event count and reports events per minute, per-stage latency and peak memory.
+
+    python benchmarks/pipeline.py --seconds 10 30 --events 5 20 --inference-latency 0.2 --workers 4
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import os
+import resource
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from unittest import mock
+
+from fakes import FakePredictor, FakeRingClient, FakeRingDevice, LocalSnowflake, make_clip
+
+import nestcam.core as core
+from nestcam.metrics import metrics
+
+# Names the pipeline writes to (read when it runs); the stand-ins accept any
+os.environ.setdefault("SNOWFLAKE_IMAGE_STAGE", "VIDEO_STREAM_IMAGES")
+os.environ.setdefault("SNOWFLAKE_INFERENCE_TABLE", "VIDEO_STREAM_INFERENCE")
+
+MODES = {"collect": core.collect_data_last_minutes, "process": core.process_events_last_minutes}
+
+
+@contextlib.contextmanager
+def _quiet():
+    """Silence the pipeline's console output, including that of the decoding worker processes."""
+    sys.stdout.flush()
+    saved = os.dup(1)
+    with open(os.devnull, "w") as devnull:
+        os.dup2(devnull.fileno(), 1)
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                yield
+        finally:
+            os.dup2(saved, 1)
+            os.close(saved)
+
+
+def run_once(mode: str, clip: str, n_events: int, run_dir: Path, args):
+    """One offline run of a pipeline command. Returns a dict of measurements."""
+    run_dir.mkdir(parents=True)
+    FakeRingClient.device = FakeRingDevice(clip, n_events, args.download_latency)
+    LocalSnowflake.root = str(run_dir / "snowflake")
+    metrics.reset()
+    with (
+        mock.patch.object(core, "RingClient", FakeRingClient),
+        mock.patch.object(core, "SnowflakePool", LocalSnowflake),
+        mock.patch.object(core, "get_predictor", lambda: FakePredictor(args.inference_latency)),
+        mock.patch.object(core, "METRICS_LOG", ""),
+        mock.patch("nestcam.ledger.LEDGER_PATH", str(run_dir / "ledger.sqlite")),
+        mock.patch(
+            "nestcam.prediction_cache.PREDICTION_CACHE_PATH",
+            str(run_dir / "prediction_cache.sqlite") if args.prediction_cache else "",
+        ),
+        _quiet(),
+    ):
+        # Recordings are downloaded relative to the working directory
+        cwd = os.getcwd()
+        os.chdir(run_dir)
+        tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            # Fake events are 30s apart, so this window covers all of them
+            asyncio.run(MODES[mode](minutes=n_events, workers=args.workers))
+        finally:
+            elapsed = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            os.chdir(cwd)
+
+    summary = metrics.summary()
+    with sqlite3.connect(run_dir / "snowflake" / "warehouse.sqlite") as db:
+        tables = [name for (name,) in db.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+        rows = sum(db.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] for table in tables)
+    staged = sum(1 for path in (run_dir / "snowflake" / "stages").rglob("*") if path.is_file())
+    return {
+        "events": summary["counters"].get(f'events_total{{pipeline="{mode}"}}', 0),
+        "elapsed": elapsed,
+        "rows": rows,
+        "staged": staged,
+        "cache_hits": summary["counters"].get("prediction_cache_hits_total", 0),
+        "peak_mb": peak / 2**20,  # Python allocations, numpy frame buffers included
+        "stages": {
+            name.split('"')[1]: stats
+            for name, stats in summary["latencies"].items()
+            if name.startswith("stage_seconds")
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=[*MODES, "both"], default="both")
+    parser.add_argument("--seconds", type=float, nargs="+", default=[10, 30], help="Clip lengths")
+    parser.add_argument("--events", type=int, nargs="+", default=[5, 20], help="Event counts")
+    parser.add_argument("--fps", type=float, default=15)
+    parser.add_argument("--width", type=int, default=640)
+    parser.add_argument("--height", type=int, default=360)
+    parser.add_argument("--download-latency", type=float, default=0.5, help="Seconds per fake recording download")
+    parser.add_argument("--inference-latency", type=float, default=0.2, help="Seconds per fake prediction")
+    parser.add_argument("--workers", type=int, default=1, help="Snapshot decoding processes (--workers)")
+    parser.add_argument(
+        "--prediction-cache",
+        action="store_true",
+        help="Reuse predictions of identical snapshots; every fake event serves the same clip, so most are hits",
+    )
+    args = parser.parse_args()
+    modes = list(MODES) if args.mode == "both" else [args.mode]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = Path(tmp)
+        print(
+            f"{args.fps:g} fps {args.width}x{args.height} clips, download {args.download_latency:g}s, "
+            f"inference {args.inference_latency:g}s/image, {args.workers} decoding worker(s)"
+        )
+        header = f"{'mode':<8} {'clip (s)':>8} {'events':>6} {'done':>5} {'rows':>6} {'staged':>6} {'cached':>6}"
+        print(f"{header} {'wall (s)':>9} {'events/min':>10} {'peak MB':>8}  stage p50/p95 (ms)")
+        runs = [(seconds, n_events, mode) for seconds in args.seconds for n_events in args.events for mode in modes]
+        for i, (seconds, n_events, mode) in enumerate(runs):
+            clip = make_clip(tmp, seconds, args.fps, (args.width, args.height))
+            result = run_once(mode, clip, n_events, workdir / f"run_{i}", args)
+            stages = "  ".join(
+                f"{name} {stats['p50_ms']:.0f}/{stats['p95_ms']:.0f}" for name, stats in result["stages"].items()
+            )
+            print(
+                f"{mode:<8} {seconds:>8g} {n_events:>6} {result['events']:>5g} "
+                f"{result['rows']:>6} {result['staged']:>6} {result['cache_hits']:>6g} "
+                f"{result['elapsed']:>9.2f} {result['events'] / result['elapsed'] * 60:>10.1f} "
+                f"{result['peak_mb']:>8.1f}  {stages}"
+            )
+        # Includes the decoding worker processes when --workers > 1
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        children_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+        print(f"max RSS: {max_rss:.0f} MB (largest worker process: {children_rss:.0f} MB)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,28 @@
+"""Synthetic test footage for the benchmarks (no Ring account needed)."""
+
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+
+def make_synthetic_video(path: str, seconds: float = 30, fps: float = 30, size: tuple = (640, 360), seed: int = 0):
+    """
+    Write an MP4 of a mostly static scene with a small square moving across it, roughly like a nest clip.
+    Returns the path of the written file.
+    """
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    width, height = size
+    rng = np.random.default_rng(seed)
+    background = rng.integers(0, 255, (height, width, 3), dtype=np.uint8)
+    background = cv2.GaussianBlur(background, (31, 31), 0)
+    writer = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*"mp4v"), fps, (width, height))
+    n_frames = int(seconds * fps)
+    for i in range(n_frames):
+        frame = background.copy()
+        x = int((i / max(n_frames - 1, 1)) * (width - 40))
+        cv2.rectangle(frame, (x, height // 2 - 20), (x + 40, height // 2 + 20), (40, 80, 200), -1)
+        noise = rng.integers(-4, 5, frame.shape, dtype=np.int16)
+        writer.write(np.clip(frame.astype(np.int16) + noise, 0, 255).astype(np.uint8))
+    writer.release()
+    return str(path)
@@ -0,0 +1,59 @@
+"""
+Compare the "read" (decode every frame) and "grab" (decode kept frames only) modes of `video_to_snapshots`.
+
+    python benchmarks/video_sampling.py --seconds 30 --fps 30 --interval 3 --repeat 3
+"""
+
+import argparse
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+from synthetic import make_synthetic_video
+
+from nestcam.video_utils import SAMPLING_MODES, video_to_snapshots
+
+
+def bench_mode(source: str, mode: str, interval: float, repeat: int, workdir: Path):
+    timings = []
+    n_snapshots = 0
+    for i in range(repeat):
+        # video_to_snapshots deletes its input, so every run works on a fresh copy
+        video = workdir / f"{mode}_{i}.mp4"
+        shutil.copy(source, video)
+        start = time.perf_counter()
+        snapshots = video_to_snapshots(str(video), interval, output_dir=str(workdir / f"{mode}_{i}"), mode=mode)
+        timings.append(time.perf_counter() - start)
+        n_snapshots = len(snapshots)
+    return min(timings), sum(timings) / len(timings), n_snapshots
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seconds", type=float, default=30)
+    parser.add_argument("--fps", type=float, default=30)
+    parser.add_argument("--width", type=int, default=1280)
+    parser.add_argument("--height", type=int, default=720)
+    parser.add_argument("--interval", type=float, default=3)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = Path(tmp)
+        source = make_synthetic_video(str(workdir / "source.mp4"), args.seconds, args.fps, (args.width, args.height))
+        print(
+            f"{args.seconds:g}s clip @ {args.fps:g} fps, {args.width}x{args.height}, "
+            f"one snapshot every {args.interval:g}s"
+        )
+        print(f"{'mode':<6} {'best (s)':>10} {'mean (s)':>10} {'snapshots':>10}")
+        results = {}
+        for mode in SAMPLING_MODES:
+            best, mean, n_snapshots = bench_mode(source, mode, args.interval, args.repeat, workdir)
+            results[mode] = best
+            print(f"{mode:<6} {best:>10.3f} {mean:>10.3f} {n_snapshots:>10}")
+        print(f"grab speedup: {results['read'] / results['grab']:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,11 @@
+-- Replace the dt_year ... dt_second columns of an existing inference table with captured_at / frame_index.
+-- The old columns hold the UTC time the recording was downloaded; new rows get the event start plus frame offset.
+ALTER TABLE VIDEO_STREAM_INFERENCE ADD COLUMN captured_at TIMESTAMP_TZ, frame_index INT;
+
+UPDATE VIDEO_STREAM_INFERENCE
+SET captured_at = TIMESTAMP_TZ_FROM_PARTS(dt_year, dt_month, dt_day, dt_hour, dt_minute, dt_second, 0, 'UTC')
+WHERE captured_at IS NULL;
+
+ALTER TABLE VIDEO_STREAM_INFERENCE DROP COLUMN dt_year, dt_month, dt_day, dt_hour, dt_minute, dt_second;
+
+-- robin_detections reads captured_at now: recreate it with `nestcam detections` (or sql/robin_detections.sql)
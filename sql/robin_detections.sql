@@ -0,0 +1,25 @@
+-- Same table `nestcam detections` creates: the best robin detection per event, refreshed incrementally by
+-- Snowflake and clustered on detected_at so dashboard queries over recent detections stay cheap.
+-- Replacing the robin_detections view of an older setup? Drop it first:
+-- DROP VIEW robin_detections;
+
+CREATE OR REPLACE DYNAMIC TABLE robin_detections
+    TARGET_LAG = '1 minute'
+    WAREHOUSE = COMPUTE_WH
+    REFRESH_MODE = INCREMENTAL
+    CLUSTER BY (detected_at)
+AS
+SELECT
+    filename,
+    endpoint_id,
+    label_name,
+    confidence,
+    bboxes,
+    event_id,
+    captured_at AS detected_at
+FROM VIDEO_STREAM_INFERENCE
+WHERE label_name = 'robin'
+QUALIFY ROW_NUMBER() OVER (PARTITION BY event_id ORDER BY confidence DESC) = 1;
+
+-- Query the table to see the latest detections
+SELECT * FROM robin_detections ORDER BY detected_at DESC LIMIT 100;
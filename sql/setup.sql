@@ -18,12 +18,8 @@ GRANT READ ON STAGE LANDINGLENS_DEMO_DB.VIDEO_STREAM.VIDEO_STREAM_IMAGES TO APPL
 CREATE TABLE VIDEO_STREAM_INFERENCE (
     filename VARCHAR,
     endpoint_id STRING,
-    dt_year INT,
-    dt_month INT,
-    dt_day INT,
-    dt_hour INT,
-    dt_minute INT,
-    dt_second INT,
+    captured_at TIMESTAMP_TZ, -- event start + frame offset in the recording
+    frame_index INT,
     label_name STRING,
     label_index INT,
     confidence FLOAT,
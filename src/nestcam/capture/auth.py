@@ -3,16 +3,28 @@ from pathlib import Path
 
 from ring_doorbell import Auth, AuthenticationError, Requires2FAError, Ring
 
-from nestcam.config import RING_PASSWORD, RING_USERNAME
+from nestcam.config import ring_credentials
 
 user_agent = "landinglens-streamlit-demo"
 cache_file = Path(user_agent + ".token.cache")
+fcm_cache_file = Path(user_agent + ".fcm.cache")
 
 
 def token_updated(token):
     cache_file.write_text(json.dumps(token))
 
 
+def load_fcm_credentials():
+    """Push notification (FCM) credentials saved by a previous event listener, if any."""
+    if fcm_cache_file.is_file():
+        return json.loads(fcm_cache_file.read_text())
+    return None
+
+
+def fcm_credentials_updated(credentials):
+    fcm_cache_file.write_text(json.dumps(credentials))
+
+
 def otp_callback():
     auth_code = input("2FA code: ")
     return auth_code
@@ -35,8 +47,9 @@ async def get_authenticated_ring():
 
 async def do_auth():
     auth = Auth(user_agent, None, token_updated)
+    username, password = ring_credentials()
     try:
-        await auth.async_fetch_token(RING_USERNAME, RING_PASSWORD)
+        await auth.async_fetch_token(username, password)
     except Requires2FAError:
-        await auth.async_fetch_token(RING_USERNAME, RING_PASSWORD, otp_callback())
+        await auth.async_fetch_token(username, password, otp_callback())
     return auth
@@ -1,8 +1,25 @@
 import asyncio
+import os
+import random
+import re
+import tempfile
 from datetime import datetime, timedelta, timezone
+from functools import partial
 from pathlib import Path
 
 from rich import print
+from ring_doorbell import AuthenticationError, RingError, RingEventListener, RingTimeout
+
+from nestcam.capture.auth import fcm_credentials_updated, get_authenticated_ring, load_fcm_credentials
+from nestcam.config import (
+    DOWNLOAD_CONCURRENCY,
+    DOWNLOAD_DEADLINE_SECONDS,
+    DOWNLOAD_RETRY_INITIAL_SECONDS,
+    DOWNLOAD_RETRY_MAX_SECONDS,
+    EVENT_POLL_MAX_SECONDS,
+    EVENT_POLL_MIN_SECONDS,
+)
+from nestcam.metrics import metrics
 
 
 def get_stickup_cam(devices, device_name=None):
@@ -18,37 +35,35 @@ def get_stickup_cam(devices, device_name=None):
     return cams[0] if cams else None
 
 
-async def get_latest_event_id(ring, auth, device_name=None):
-    device = get_stickup_cam(ring.devices(), device_name)
-    if not device:
-        await auth.async_close()
-        print("[red]No stickup camera found[/red]")
-        return None
-    history = await device.async_history(limit=1)
-    await auth.async_close()
-    if history:
-        return history[0]["id"]
-    return None
+class RingClient:
+    """
+    Long-lived Ring session. It authenticates once and keeps the aiohttp session, with its pooled keep-alive
+    connections, open for every call until `close()`. Expired access tokens are refreshed by ring_doorbell's Auth
+    with the refresh token and saved through `token_updated`, so a running process never needs a full re-auth.
+    """
 
+    def __init__(self, ring, auth):
+        self.ring = ring
+        self.auth = auth
 
-async def new_recording_event(ring, auth, previous_id, device_name=None):
-    device = get_stickup_cam(ring.devices(), device_name)
-    if not device:
-        await auth.async_close()
-        print("[red]No stickup camera found[/red]")
-        return None, previous_id
-    history = await device.async_history(limit=1)
-    await auth.async_close()
-    if history:
-        latest_event = history[0]
-        if latest_event["id"] != previous_id:
-            print(f"[green]New recording event detected on {device.name}: {latest_event['id']}[/green]")
-            return latest_event, latest_event["id"]
-        else:
-            print(f"[yellow]No new recording event on {device.name}[/yellow]")
-            return None, previous_id
-    print(f"[yellow]No events found for {device.name}[/yellow]")
-    return None, previous_id
+    @classmethod
+    async def connect(cls):
+        ring, auth = await get_authenticated_ring()
+        with metrics.time("ring_request_seconds", call="update_data"):
+            await ring.async_update_data()
+        return cls(ring, auth)
+
+    def devices(self):
+        return self.ring.devices()
+
+    async def close(self):
+        await self.auth.async_close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
 
 
 async def get_recent_events(ring, device_name=None, limit=100, minutes=60):
@@ -62,35 +77,258 @@ async def get_recent_events(ring, device_name=None, limit=100, minutes=60):
 
     now = datetime.now(timezone.utc)
     since = now - timedelta(minutes=minutes)
-    history = await device.async_history(limit=limit)
+    with metrics.time("ring_request_seconds", call="history"):
+        history = await device.async_history(limit=limit)
 
-    recent_events = []
-    for event in history:
-        created_at = event.get("created_at")
-        if isinstance(created_at, datetime):
-            created_at_dt = created_at
-        else:
-            created_at_dt = datetime.fromtimestamp(created_at, tz=timezone.utc)
-        if created_at_dt >= since:
-            recent_events.append(event)
-    return recent_events
+    return [event for event in history if event_time(event) >= since]
 
 
-async def download_recording(ring, auth, recording_id, device_name=None, snapshot_dir: str = "snapshots"):
-    # Check snapshot_dir exists
-    Path(snapshot_dir).mkdir(parents=True, exist_ok=True)
-    device = get_stickup_cam(ring.devices(), device_name)
-    if not device:
-        await auth.async_close()
-        return None
-    timestamp = datetime.now(timezone.utc).strftime("%Y%m%d%H%M%S")  # TODO: use event timestamp
-    filename = f"{snapshot_dir}/{device.id}_{recording_id}_{timestamp}.mp4"
-    # Wait until the video is ready to download
-    while True:
-        try:
-            await device.async_recording_download(recording_id, filename)
-            break
-        except Exception as e:
-            print(f"[yellow]Recording not ready yet, retrying... ({e})[/yellow]")
-            await asyncio.sleep(2)
+def event_time(event):
+    """
+    When a history event started, as an aware UTC datetime. ring_doorbell gives `created_at` as a datetime, the raw
+    API as an ISO string or epoch seconds.
+    """
+    created_at = event["created_at"]
+    if isinstance(created_at, datetime):
+        created = created_at
+    elif isinstance(created_at, (int, float)):
+        created = datetime.fromtimestamp(created_at, tz=timezone.utc)
+    else:
+        created = datetime.fromisoformat(str(created_at).replace("Z", "+00:00"))
+    return created.astimezone(timezone.utc) if created.tzinfo else created.replace(tzinfo=timezone.utc)
+
+
+def _recording_stem(device, recording_id, created_at=None):
+    timestamp = (created_at or datetime.now(timezone.utc)).strftime("%Y%m%d%H%M%S")
+    return f"{device.id}_{recording_id}_{timestamp}"
+
+
+def recording_stem(video_file):
+    """Stem of the recording a file written by `DownloadScheduler.download` holds, without its unique suffix."""
+    return Path(video_file).name.split(".", 1)[0]
+
+
+class RecordingNotReady(Exception):
+    """The recording can't be downloaded yet (not processed, rate limited, timeout); worth retrying later."""
+
+
+def _status_code(error):
+    match = re.search(r"status code (?:is )?(\d{3})", str(error))
+    return int(match.group(1)) if match else None
+
+
+def _raise_if_not_ready(error):
+    """Re-raise a Ring API error as RecordingNotReady when it is worth retrying later."""
+    if isinstance(error, AuthenticationError):
+        return
+    status = _status_code(error)
+    if isinstance(error, RingTimeout) or status is None or status in (404, 429) or status >= 500:
+        raise RecordingNotReady(str(error)) from error
+
+
+async def try_download_recording(device, recording_id, filename):
+    """
+    One download attempt. Raises RecordingNotReady for errors worth retrying (404 while Ring is still processing
+    the clip, 429, 5xx, timeouts, connection errors); any other error is fatal for this recording.
+    """
+    try:
+        with metrics.time("ring_request_seconds", call="recording_download"):
+            await device.async_recording_download(recording_id, filename, override=True)
+    except RingError as e:
+        _raise_if_not_ready(e)
+        raise
+    if not Path(filename).is_file() or Path(filename).stat().st_size == 0:
+        # ring_doorbell returns without writing anything when the account has no subscription
+        raise RingError(f"Recording {recording_id} was not downloaded (no active Ring subscription?)")
+    metrics.inc("download_bytes_total", Path(filename).stat().st_size)
     return filename
+
+
+async def try_recording_url(device, recording_id):
+    """One attempt at getting the signed HTTPS URL of a recording, with the same error handling as a download."""
+    try:
+        with metrics.time("ring_request_seconds", call="recording_url"):
+            url = await device.async_recording_url(recording_id)
+    except RingError as e:
+        _raise_if_not_ready(e)
+        raise
+    if not url:
+        raise RingError(f"No URL for recording {recording_id} (no active Ring subscription?)")
+    return url
+
+
+class DownloadScheduler:
+    """
+    Downloads recordings, retrying "not ready yet" with exponential backoff (plus jitter) until `deadline` seconds.
+    Only `max_active` downloads are in flight at once; a recording waiting for its next retry is parked on the event
+    loop's timer queue and holds no slot, so ready recordings keep moving.
+    """
+
+    def __init__(
+        self,
+        ring,
+        max_active: int = None,
+        deadline: float = None,
+        initial_delay: float = None,
+        max_delay: float = None,
+    ):
+        self.ring = ring
+        self.deadline = deadline or DOWNLOAD_DEADLINE_SECONDS
+        self.initial_delay = initial_delay or DOWNLOAD_RETRY_INITIAL_SECONDS
+        self.max_delay = max_delay or DOWNLOAD_RETRY_MAX_SECONDS
+        self._active = asyncio.Semaphore(max_active or DOWNLOAD_CONCURRENCY)
+
+    async def _attempt(self, attempt):
+        async with self._active:
+            return await attempt()
+
+    async def _with_retries(self, recording_id, attempt):
+        loop = asyncio.get_running_loop()
+        give_up_at = loop.time() + self.deadline
+        delay = self.initial_delay
+        while True:
+            try:
+                return await self._attempt(attempt)
+            except RecordingNotReady as e:
+                wait = random.uniform(delay / 2, delay)
+                if loop.time() + wait > give_up_at:
+                    print(f"[red]Recording {recording_id} not ready after {self.deadline:.0f}s, giving up ({e})[/red]")
+                    return None
+                print(f"[yellow]Recording {recording_id} not ready yet, retrying in {wait:.1f}s ({e})[/yellow]")
+                await asyncio.sleep(wait)
+                delay = min(delay * 2, self.max_delay)
+            except Exception as e:
+                print(f"[red]Failed to fetch recording {recording_id}: {e}[/red]")
+                return None
+
+    async def download(self, recording_id, device_name=None, snapshot_dir: str = "snapshots", created_at=None):
+        """
+        Path of the downloaded MP4, or None if the recording failed or wasn't ready before the deadline.
+        The file is named `<stem>.<unique suffix>.mp4`, the stem (see `recording_stem`) after the event's `created_at`
+        (see `event_time`), or the current time without it. The suffix is new for every download, so processes
+        handling the same event (e.g. `nestcam run` and a cron `process-events`) never write to or delete each other's
+        file.
+        """
+        Path(snapshot_dir).mkdir(parents=True, exist_ok=True)
+        device = get_stickup_cam(self.ring.devices(), device_name)
+        if not device:
+            return None
+        fd, filename = tempfile.mkstemp(
+            dir=snapshot_dir, prefix=f"{_recording_stem(device, recording_id, created_at)}.", suffix=".mp4"
+        )
+        os.close(fd)
+        downloaded = await self._with_retries(
+            recording_id, partial(try_download_recording, device, recording_id, filename)
+        )
+        if not downloaded:
+            Path(filename).unlink(missing_ok=True)
+        return downloaded
+
+    async def recording_url(self, recording_id, device_name=None, created_at=None):
+        """
+        (signed URL, file stem) to stream the recording from instead of downloading it, or None if it failed or
+        wasn't ready before the deadline.
+        """
+        device = get_stickup_cam(self.ring.devices(), device_name)
+        if not device:
+            return None
+        url = await self._with_retries(recording_id, partial(try_recording_url, device, recording_id))
+        return (url, _recording_stem(device, recording_id, created_at)) if url else None
+
+
+async def start_event_listener(ring):
+    """Start ring_doorbell's push notification listener, or return None (poll only) if it is unavailable."""
+    try:
+        listener = RingEventListener(ring, load_fcm_credentials(), fcm_credentials_updated)
+        if await listener.start():
+            print("[green]Listening for Ring push notifications[/green]")
+            return listener
+    except Exception as e:
+        print(f"[yellow]Ring push notifications unavailable, polling only ({e})[/yellow]")
+        return None
+    print("[yellow]Ring push notifications unavailable, polling only[/yellow]")
+    return None
+
+
+class HistoryEventSource:
+    """
+    Every new recording event of a camera, oldest first. Each poll pages back through the device history until it
+    reaches the cursor (the newest id already seen), so bursts between polls are not lost. The poll interval drops
+    to `min_interval` after activity and backs off by `backoff` up to `max_interval` while idle or while polls fail;
+    the cursor survives failed polls, so events that arrive meanwhile are picked up by the next successful one. With a
+    push listener attached, a Ring notification for the camera wakes the poller immediately.
+    """
+
+    def __init__(
+        self,
+        ring,
+        device_name=None,
+        cursor=None,
+        min_interval: float = None,
+        max_interval: float = None,
+        backoff: float = 2.0,
+        page_size: int = 20,
+        max_pages: int = 10,
+    ):
+        self.ring = ring
+        self.device_name = device_name
+        self.cursor = int(cursor) if cursor is not None else None
+        self.min_interval = min_interval or EVENT_POLL_MIN_SECONDS
+        self.max_interval = max_interval or EVENT_POLL_MAX_SECONDS
+        self.backoff = backoff
+        self.page_size = page_size
+        self.max_pages = max_pages
+        self._wakeup = asyncio.Event()
+
+    async def fetch_new(self):
+        """Events newer than the cursor, oldest first. Without a cursor only the latest event is returned."""
+        device = get_stickup_cam(self.ring.devices(), self.device_name)
+        if not device:
+            return []
+        if self.cursor is None:
+            with metrics.time("ring_request_seconds", call="history"):
+                new_events = await device.async_history(limit=1)
+        else:
+            new_events = []
+            older_than = None
+            for _ in range(self.max_pages):
+                with metrics.time("ring_request_seconds", call="history"):
+                    page = await device.async_history(limit=self.page_size, older_than=older_than)
+                fresh = [event for event in page if int(event["id"]) > self.cursor]
+                new_events.extend(fresh)
+                if len(fresh) < len(page) or not page:
+                    break
+                older_than = page[-1]["id"]
+            else:
+                print(f"[yellow]More than {self.max_pages * self.page_size} new events, older ones skipped[/yellow]")
+        if new_events:
+            self.cursor = max(int(event["id"]) for event in new_events)
+            print(f"[green]{len(new_events)} new recording event(s) detected on {device.name}[/green]")
+        return sorted(new_events, key=lambda event: int(event["id"]))
+
+    def attach_listener(self, listener):
+        """Wake up the poller whenever `listener` (a started RingEventListener) reports an event for this camera."""
+        listener.add_notification_callback(self._on_notification)
+
+    def _on_notification(self, event):
+        if self.device_name is None or event.device_name == self.device_name:
+            self._wakeup.set()
+
+    async def events(self):
+        interval = self.min_interval
+        while True:
+            # Cleared before polling so that a notification arriving mid-poll still triggers the next one
+            self._wakeup.clear()
+            try:
+                new_events = await self.fetch_new()
+            except Exception as e:
+                new_events = []
+                print(f"[yellow]Polling events of {self.device_name or 'camera'} failed, retrying ({e})[/yellow]")
+            for event in new_events:
+                yield event
+            interval = self.min_interval if new_events else min(interval * self.backoff, self.max_interval)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=interval)
+                interval = self.min_interval
+            except asyncio.TimeoutError:
+                pass
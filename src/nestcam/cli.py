@@ -18,33 +18,92 @@ def streamlit():
 
 
 @app.command()
-def process_events(device_name: str = "Front Door", minutes: int = 60):
+def process_events(
+    device_name: str = "Front Door",
+    minutes: int = 60,
+    workers: int = typer.Option(None, help="Processes decoding recordings (default NESTCAM_SNAPSHOT_WORKERS)."),
+):
     """Process all Ring events from the last 60 minutes."""
     from nestcam.core import process_events_last_minutes
 
     try:
-        asyncio.run(process_events_last_minutes(device_name=device_name, minutes=minutes))
+        asyncio.run(process_events_last_minutes(device_name=device_name, minutes=minutes, workers=workers))
     except KeyboardInterrupt:
         typer.echo("Processing last hour stopped.")
 
 
 @app.command()
-def collect_data(device_name: str = "Front Door", minutes: int = 60):
+def collect_data(
+    device_name: str = "Front Door",
+    minutes: int = 60,
+    workers: int = typer.Option(None, help="Processes decoding recordings (default NESTCAM_SNAPSHOT_WORKERS)."),
+):
     """Download all Ring events from the last `minutes` and upload snapshots to Snowflake (no inference)."""
     from nestcam.core import collect_data_last_minutes
 
     try:
-        asyncio.run(collect_data_last_minutes(device_name=device_name, minutes=minutes))
+        asyncio.run(collect_data_last_minutes(device_name=device_name, minutes=minutes, workers=workers))
     except KeyboardInterrupt:
         typer.echo("Collecting data stopped.")
 
 
 @app.command()
-def run(device_name: str = "Front Door"):
-    """Run the Ring capture pipeline."""
+def run(
+    device_name: list[str] = typer.Option(["Front Door"], help="Camera to watch, repeat for several cameras."),
+    all_devices: bool = typer.Option(False, "--all-devices", help="Watch every stickup camera on the account."),
+):
+    """Run the Ring capture pipeline for one or more cameras in a single process."""
     from nestcam.core import event_loop
 
     try:
-        asyncio.run(event_loop(device_name=device_name))
+        asyncio.run(event_loop(device_names=device_name, all_devices=all_devices))
     except KeyboardInterrupt:
         typer.echo("Ring capture pipeline stopped.")
+
+
+@app.command()
+def detections(
+    target_lag: str = typer.Option(
+        None, help="How stale the table may get, e.g. '1 minute' (default NESTCAM_DETECTIONS_TARGET_LAG)."
+    ),
+    refresh: bool = typer.Option(False, "--refresh", help="Only refresh the existing table now."),
+    warehouse: str = typer.Option(None, help="Warehouse the refreshes run on (default SNOWFLAKE_WAREHOUSE)."),
+):
+    """Create (or refresh) the incrementally maintained detections table the Streamlit app reads."""
+    from nestcam.config import snowflake_config
+    from nestcam.snowflake_utils import SnowflakePool, create_detections_table, refresh_detections_table
+
+    if not refresh and not (warehouse or snowflake_config()["warehouse"]):
+        typer.echo("No warehouse for the detections table: set SNOWFLAKE_WAREHOUSE or pass --warehouse.")
+        raise typer.Exit(1)
+    with SnowflakePool(size=1) as pool:
+        if refresh:
+            pool.run(refresh_detections_table)
+            typer.echo("Detections table refreshed.")
+        else:
+            pool.run(create_detections_table, target_lag=target_lag, warehouse=warehouse)
+            typer.echo("Detections table created.")
+
+
+@app.command()
+def stats(
+    log: Path = typer.Option(None, help="Metrics log to read (default NESTCAM_METRICS_LOG)."),
+    command: str = typer.Option(None, help="Only runs of this command, e.g. process-events."),
+    last: int = typer.Option(1, help="Number of most recent records to show."),
+):
+    """Summarize the pipeline metrics recorded by previous runs (stage latencies, counters, queue depths)."""
+    from nestcam.config import METRICS_LOG
+    from nestcam.metrics import format_summary, read_jsonl
+
+    log = log or Path(METRICS_LOG)
+    if not log.is_file():
+        typer.echo(f"No metrics log at {log}, run a pipeline command first.")
+        raise typer.Exit(1)
+    records = [record for record in read_jsonl(log) if command is None or record.get("command") == command]
+    if not records:
+        typer.echo("No matching metrics records.")
+        raise typer.Exit(1)
+    for record in records[-last:]:
+        typer.echo(f"{record['time']} {record.get('command', '')}")
+        for line in format_summary(record):
+            typer.echo(f"  {line}")
@@ -2,27 +2,130 @@ import os
 
 from dotenv import load_dotenv
 
+# .env is loaded on import because the NESTCAM_* settings below may come from it
 load_dotenv()
 
-RING_USERNAME = os.getenv("RING_USERNAME")
-RING_PASSWORD = os.getenv("RING_PASSWORD")
 
-# Support both password and SSO (external browser) authentication for Snowflake
-SNOWFLAKE_AUTHENTICATOR = os.getenv("SNOWFLAKE_AUTHENTICATOR")  # externalbrowser
+# Account settings (Ring, Snowflake, LandingAI) are read from the environment when they are used, not when this
+# module is imported, so they reflect what the caller set up after import (e.g. the Streamlit app or a benchmark)
+def ring_credentials():
+    """(username, password) of the Ring account."""
+    return os.getenv("RING_USERNAME"), os.getenv("RING_PASSWORD")
+
+
+def snowflake_config():
+    """Keyword arguments of `snowflake.connector.connect`."""
+    return {
+        "user": os.getenv("SNOWFLAKE_USER"),
+        "password": os.getenv("SNOWFLAKE_PASSWORD"),
+        "account": os.getenv("SNOWFLAKE_ACCOUNT"),
+        "warehouse": os.getenv("SNOWFLAKE_WAREHOUSE"),
+        "database": os.getenv("SNOWFLAKE_DATABASE"),
+        "schema": os.getenv("SNOWFLAKE_SCHEMA"),
+        # Support both password and SSO (external browser) authentication for Snowflake
+        "authenticator": os.getenv("SNOWFLAKE_AUTHENTICATOR"),  # externalbrowser
+    }
+
+
+def snowflake_image_stage():
+    return os.getenv("SNOWFLAKE_IMAGE_STAGE")  # e.g. 'my_stage'
+
+
+def snowflake_inference_table():
+    return os.getenv("SNOWFLAKE_INFERENCE_TABLE")  # e.g. 'my_table'
+
+
+def landingai_config():
+    """Native app URL and LandingLens endpoint of the predictor."""
+    return {
+        "native_app_url": os.getenv("LANDINGAI_APP_URL"),  # e.g. 'https://app.landing.ai'
+        "endpoint_id": os.getenv("LANDINGLENS_ENDPOINT_ID"),  # e.g. 'my_endpoint_id'
+    }
 
-SNOWFLAKE_CONFIG = {
-    "user": os.getenv("SNOWFLAKE_USER"),
-    "password": os.getenv("SNOWFLAKE_PASSWORD"),
-    "account": os.getenv("SNOWFLAKE_ACCOUNT"),
-    "warehouse": os.getenv("SNOWFLAKE_WAREHOUSE"),
-    "database": os.getenv("SNOWFLAKE_DATABASE"),
-    "schema": os.getenv("SNOWFLAKE_SCHEMA"),
-    "authenticator": SNOWFLAKE_AUTHENTICATOR,
-}
 
-SNOWFLAKE_IMAGE_STAGE = os.getenv("SNOWFLAKE_IMAGE_STAGE")  # e.g. 'my_stage'
-SNOWFLAKE_INFERENCE_TABLE = os.getenv("SNOWFLAKE_INFERENCE_TABLE")  # e.g. 'my_table'
 CAPTURE_INTERVAL_SECONDS = 30
 
-LANDINGAI_APP_URL = os.getenv("LANDINGAI_APP_URL")  # e.g. 'https://app.landing.ai'
-LANDINGLENS_ENDPOINT_ID = os.getenv("LANDINGLENS_ENDPOINT_ID")  # e.g. 'my_endpoint_id'
+# Concurrency per pipeline stage (see nestcam.pipeline) when processing a batch of events
+DOWNLOAD_CONCURRENCY = int(os.getenv("NESTCAM_DOWNLOAD_CONCURRENCY", 2))
+SNAPSHOT_CONCURRENCY = int(os.getenv("NESTCAM_SNAPSHOT_CONCURRENCY", 2))
+INFERENCE_CONCURRENCY = int(os.getenv("NESTCAM_INFERENCE_CONCURRENCY", 2))
+UPLOAD_CONCURRENCY = int(os.getenv("NESTCAM_UPLOAD_CONCURRENCY", 2))
+PIPELINE_QUEUE_SIZE = int(os.getenv("NESTCAM_PIPELINE_QUEUE_SIZE", 4))
+
+# LandingLens inference: parallel calls per batch of snapshots, per-call timeout and retries
+INFERENCE_WORKERS = int(os.getenv("NESTCAM_INFERENCE_WORKERS", 4))
+INFERENCE_TIMEOUT_SECONDS = float(os.getenv("NESTCAM_INFERENCE_TIMEOUT_SECONDS", 30))
+INFERENCE_RETRIES = int(os.getenv("NESTCAM_INFERENCE_RETRIES", 3))
+
+# Number of threads Snowflake uses for a bulk PUT of snapshots (1-99)
+PUT_PARALLEL = int(os.getenv("NESTCAM_PUT_PARALLEL", 8))
+
+# How inference rows are written: "insert" (bound multi-row INSERT) or "copy" (staged NDJSON + COPY INTO)
+INFERENCE_WRITE_METHOD = os.getenv("NESTCAM_INFERENCE_WRITE_METHOD", "insert")
+INSERT_CHUNK_ROWS = int(os.getenv("NESTCAM_INSERT_CHUNK_ROWS", 1000))
+
+# Snapshots stay in memory from decoding to upload; set to also write them to data/snapshots for debugging
+SAVE_SNAPSHOTS = os.getenv("NESTCAM_SAVE_SNAPSHOTS", "").lower() in ("1", "true", "yes")
+
+# Skip snapshots that barely differ from the last kept one ("diff" or "phash", see nestcam.video_utils.iter_distinct).
+# Off by default (0): every skipped snapshot is a possible missed detection. With "diff" at 0.05, a subject smaller
+# than about 10x10 pixels of a 640x360 frame that appears in an otherwise still scene is skipped.
+PREFILTER_METHOD = os.getenv("NESTCAM_PREFILTER_METHOD", "diff")
+PREFILTER_THRESHOLD = float(os.getenv("NESTCAM_PREFILTER_THRESHOLD", 0))
+
+# Local record of which recordings each pipeline already finished (see nestcam.ledger)
+LEDGER_PATH = os.getenv("NESTCAM_LEDGER_PATH", "data/ledger.sqlite")
+
+# Live event polling: interval shrinks to the minimum on activity and backs off to the maximum when idle
+EVENT_POLL_MIN_SECONDS = float(os.getenv("NESTCAM_EVENT_POLL_MIN_SECONDS", 2))
+EVENT_POLL_MAX_SECONDS = float(os.getenv("NESTCAM_EVENT_POLL_MAX_SECONDS", 60))
+# Wake the poller on Ring push notifications when the listener can be started
+RING_PUSH_NOTIFICATIONS = os.getenv("NESTCAM_RING_PUSH_NOTIFICATIONS", "true").lower() in ("1", "true", "yes")
+
+# Endpoint calls in flight at once in `nestcam run`, across all cameras, inference stage workers and their
+# INFERENCE_WORKERS threads (downloads are capped by DOWNLOAD_CONCURRENCY, which all cameras share)
+GLOBAL_INFERENCE_LIMIT = int(os.getenv("NESTCAM_GLOBAL_INFERENCE_LIMIT", 4))
+
+# Recordings that aren't ready yet are retried with exponential backoff until the deadline. Up to
+# DOWNLOAD_PENDING_LIMIT recordings can wait for a retry while DOWNLOAD_CONCURRENCY downloads are in flight.
+DOWNLOAD_DEADLINE_SECONDS = float(os.getenv("NESTCAM_DOWNLOAD_DEADLINE_SECONDS", 600))
+DOWNLOAD_RETRY_INITIAL_SECONDS = float(os.getenv("NESTCAM_DOWNLOAD_RETRY_INITIAL_SECONDS", 2))
+DOWNLOAD_RETRY_MAX_SECONDS = float(os.getenv("NESTCAM_DOWNLOAD_RETRY_MAX_SECONDS", 60))
+DOWNLOAD_PENDING_LIMIT = int(os.getenv("NESTCAM_DOWNLOAD_PENDING_LIMIT", 16))
+
+# Sample snapshots while the recording is fetched from its URL instead of downloading the whole MP4 first
+# (needs an OpenCV build whose FFmpeg supports HTTPS, which the opencv-python wheels do). A stream that can't be
+# opened or ends short of the recording's length falls back to downloading it
+STREAM_RECORDINGS = os.getenv("NESTCAM_STREAM_RECORDINGS", "").lower() in ("1", "true", "yes")
+
+# Processes decoding recordings in process-events / collect-data (--workers); 1 decodes on a thread instead
+SNAPSHOT_WORKERS = int(os.getenv("NESTCAM_SNAPSHOT_WORKERS", 1))
+
+# Snowflake connection pool (see nestcam.snowflake_utils.SnowflakePool): connections shared by uploads, and how long
+# a connection may sit idle before it is checked with a query on checkout
+SNOWFLAKE_POOL_SIZE = int(os.getenv("NESTCAM_SNOWFLAKE_POOL_SIZE", 4))
+SNOWFLAKE_HEALTH_CHECK_SECONDS = float(os.getenv("NESTCAM_SNOWFLAKE_HEALTH_CHECK_SECONDS", 300))
+
+# Deduplicated detections the dashboard reads: a dynamic table kept up to date by Snowflake (`nestcam detections`)
+DETECTIONS_TABLE = os.getenv("NESTCAM_DETECTIONS_TABLE", "robin_detections")
+DETECTIONS_LABEL = os.getenv("NESTCAM_DETECTIONS_LABEL", "robin")
+DETECTIONS_TARGET_LAG = os.getenv("NESTCAM_DETECTIONS_TARGET_LAG", "1 minute")
+
+# Snapshots the Streamlit app fetched from the image stage, kept on disk up to a size limit (least recently used
+# files are evicted first)
+IMAGE_CACHE_DIR = os.getenv("NESTCAM_IMAGE_CACHE_DIR", "data/image_cache")
+IMAGE_CACHE_MAX_MB = float(os.getenv("NESTCAM_IMAGE_CACHE_MAX_MB", 200))
+
+# Pipeline metrics (see nestcam.metrics): serve them in Prometheus text format on this port (0 = off), and append a
+# JSON line per run (and every METRICS_LOG_SECONDS in `nestcam run`) to METRICS_LOG for `nestcam stats`
+METRICS_PORT = int(os.getenv("NESTCAM_METRICS_PORT", 0))
+METRICS_LOG = os.getenv("NESTCAM_METRICS_LOG", "data/metrics.jsonl")
+METRICS_LOG_SECONDS = float(os.getenv("NESTCAM_METRICS_LOG_SECONDS", 300))
+
+# Predictions already made for an image are reused instead of calling the endpoint again (see
+# nestcam.prediction_cache); an empty path disables the cache. Images match on the SHA-256 of their bytes, or with
+# "phash" on their perceptual hash, which also matches near-identical frames. A different endpoint id never matches.
+PREDICTION_CACHE_PATH = os.getenv("NESTCAM_PREDICTION_CACHE_PATH", "data/prediction_cache.sqlite")
+PREDICTION_CACHE_KEY = os.getenv("NESTCAM_PREDICTION_CACHE_KEY", "sha256")
+PREDICTION_CACHE_MAX_ENTRIES = int(os.getenv("NESTCAM_PREDICTION_CACHE_MAX_ENTRIES", 100000))
+PREDICTION_CACHE_MAX_AGE_DAYS = float(os.getenv("NESTCAM_PREDICTION_CACHE_MAX_AGE_DAYS", 30))
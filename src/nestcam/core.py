@@ -1,122 +1,494 @@
 import asyncio
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from pathlib import Path
 
-from landingai.predict import SnowflakeNativeAppPredictor
 from rich import print
 
-from nestcam.capture.auth import get_authenticated_ring
-from nestcam.capture.ring_client import download_recording, get_recent_events, new_recording_event
-from nestcam.config import LANDINGAI_APP_URL, LANDINGLENS_ENDPOINT_ID, SNOWFLAKE_CONFIG
-from nestcam.inference import run_inference_on_images
+from nestcam.capture.ring_client import (
+    DownloadScheduler,
+    HistoryEventSource,
+    RingClient,
+    event_time,
+    get_recent_events,
+    recording_stem,
+    start_event_listener,
+)
+from nestcam.config import (
+    DOWNLOAD_CONCURRENCY,
+    DOWNLOAD_PENDING_LIMIT,
+    GLOBAL_INFERENCE_LIMIT,
+    INFERENCE_CONCURRENCY,
+    METRICS_LOG,
+    METRICS_LOG_SECONDS,
+    METRICS_PORT,
+    PIPELINE_QUEUE_SIZE,
+    PREFILTER_METHOD,
+    PREFILTER_THRESHOLD,
+    RING_PUSH_NOTIFICATIONS,
+    SAVE_SNAPSHOTS,
+    SNAPSHOT_CONCURRENCY,
+    SNAPSHOT_WORKERS,
+    STREAM_RECORDINGS,
+    UPLOAD_CONCURRENCY,
+    landingai_config,
+    snowflake_config,
+)
+from nestcam.inference import create_predictor, run_inference_on_images
+from nestcam.ledger import EventLedger
+from nestcam.metrics import format_summary, metrics, serve_prometheus
+from nestcam.pipeline import Stage, run_pipeline
+from nestcam.prediction_cache import get_prediction_cache
 from nestcam.snowflake_utils import (
-    get_snowflake_connection_and_cursor,
+    SnowflakePool,
     upload_images_to_snowflake,
     upload_inference_results_to_snowflake,
 )
-from nestcam.video_utils import video_to_snapshots
+from nestcam.video_utils import drop_near_duplicates, iter_distinct, iter_frames, save_snapshots, video_to_frames
 
 
 def get_predictor():
-    return SnowflakeNativeAppPredictor(
-        endpoint_id=LANDINGLENS_ENDPOINT_ID,
-        native_app_url=LANDINGAI_APP_URL,
-        snowflake_account=SNOWFLAKE_CONFIG["account"],
-        snowflake_user=SNOWFLAKE_CONFIG["user"],
-        snowflake_password=SNOWFLAKE_CONFIG["password"],
-        snowflake_authenticator=SNOWFLAKE_CONFIG.get("authenticator", None),
+    snowflake = snowflake_config()
+    return create_predictor(
+        **landingai_config(),
+        snowflake_account=snowflake["account"],
+        snowflake_user=snowflake["user"],
+        snowflake_password=snowflake["password"],
+        snowflake_authenticator=snowflake.get("authenticator", None),
     )
 
 
-async def process_recording_event(ring, auth, recording_id, cursor, predictor, device_name=None):
-    video_file = await download_recording(ring, auth, recording_id, device_name)
-    if not video_file:
-        return
-    print(f"Parsing video {video_file} into snapshots")
-    image_files = video_to_snapshots(video_file)
-    print(f"Running inference on {len(image_files)} snapshots")
-    inference_results = run_inference_on_images(image_files, predictor)
-    print(f"Uploading {len(image_files)} snapshots to Snowflake")
-    upload_images_to_snowflake(image_files, cursor)
-    print("Uploading inference results to Snowflake")
-    upload_inference_results_to_snowflake(inference_results, cursor)
-
-
-async def check_new_event_and_process(ring, auth, previous_id, cursor, predictor, device_name=None):
-    event, new_id = await new_recording_event(ring, auth, previous_id, device_name)
-    if event:
-        await process_recording_event(ring, auth, new_id, cursor, predictor, device_name)
-        await asyncio.sleep(10)
-    return new_id
-
-
-async def process_events_last_minutes(device_name=None, minutes=60):
-    """Process all Ring events from the last `minutes` minutes."""
+def get_snapshot_executor(workers):
+    """A process pool for decoding recordings with more than one worker, otherwise None (default thread pool)."""
+    if workers <= 1:
+        return None
+    # spawn rather than fork: the parent runs an event loop and thread pools that must not be copied mid-flight
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+
+
+def extract_snapshots(video_file):
+    """
+    In-memory snapshots of a downloaded recording without near-duplicates, also written to data/snapshots when
+    SAVE_SNAPSHOTS is set.
+    """
+    snapshots = video_to_frames(video_file, name=recording_stem(video_file))
+    if PREFILTER_THRESHOLD > 0:
+        snapshots, dropped = drop_near_duplicates(snapshots, PREFILTER_THRESHOLD, PREFILTER_METHOD)
+        print(f"Prefilter kept {len(snapshots)} snapshots, dropped {dropped} near-duplicates")
+    if SAVE_SNAPSHOTS:
+        save_snapshots(snapshots)
+    return snapshots
+
+
+def _extract_snapshots_in_worker(video_file):
+    """`extract_snapshots` in a worker process, also returning the counters it recorded for the parent to merge."""
+    metrics.reset()
+    snapshots = extract_snapshots(video_file)
+    return snapshots, metrics.counters()
+
+
+def stream_snapshots(url, name, predictor=None, prediction_cache=None, inference_limiter=None):
+    """
+    Sample snapshots while the recording is still being fetched from `url`. With a predictor every snapshot goes to
+    inference (or is answered from `prediction_cache`) as soon as it is decoded, with endpoint calls capped by
+    `inference_limiter`. Returns (snapshots, inference results or None).
+    """
+    stats = {"dropped": 0}
+    snapshots = iter_frames(url, name=name)
+    if PREFILTER_THRESHOLD > 0:
+        snapshots = iter_distinct(snapshots, PREFILTER_THRESHOLD, PREFILTER_METHOD, stats)
+    inference_results = None
+    if predictor is not None:
+        inference_results = run_inference_on_images(
+            snapshots, predictor, cache=prediction_cache, limiter=inference_limiter
+        )
+        snapshots = [result["snapshot"] for result in inference_results]
+    else:
+        snapshots = list(snapshots)
+    if PREFILTER_THRESHOLD > 0:
+        print(f"Prefilter kept {len(snapshots)} snapshots, dropped {stats['dropped']} near-duplicates")
+    if SAVE_SNAPSHOTS:
+        save_snapshots(snapshots)
+    return snapshots, inference_results
+
+
+def start_metrics_server():
+    if METRICS_PORT:
+        serve_prometheus(METRICS_PORT)
+        print(f"Serving metrics at http://localhost:{METRICS_PORT}/metrics")
+
+
+def report_metrics(command):
+    """Print the metrics of this run and append them to METRICS_LOG (read by `nestcam stats`)."""
+    for line in format_summary(metrics.summary()):
+        print(line)
+    if METRICS_LOG:
+        metrics.write_jsonl(METRICS_LOG, command=command)
+
+
+async def _log_metrics_periodically(command):
+    while True:
+        await asyncio.sleep(METRICS_LOG_SECONDS)
+        if METRICS_LOG:
+            metrics.write_jsonl(METRICS_LOG, command=command)
+
+
+def _check_inference(job):
+    """Raise if inference failed for any snapshot of `job`, so the event isn't marked inferred and is retried."""
+    errors = [result for result in job["inference_results"] if "error" in result]
+    if errors:
+        raise RuntimeError(
+            f"Inference failed for {len(errors)} of {len(job['inference_results'])} snapshots of recording "
+            f"{job['recording_id']}: {errors[0]['error']}"
+        )
+
+
+def _tag_snapshots(job):
+    """Attach the event of `job` to its snapshots (after decoding, which may happen in another process)."""
+    for snapshot in job["snapshots"]:
+        snapshot.event_id = str(job["recording_id"])
+        snapshot.event_time = job["created_at"]
+
+
+def build_event_stages(
+    client,
+    pool,
+    predictor=None,
+    device_name=None,
+    ledger=None,
+    inference_limiter=None,
+    snapshot_executor=None,
+    snapshot_workers=None,
+    prediction_cache=None,
+):
+    """
+    Pipeline stages for Ring history events: download -> snapshots -> inference -> upload. Events are recordings of
+    `device_name`, unless they carry their own "device_name" (live events of several cameras in one pipeline).
+    Snapshots are tagged with their event's id and start time, which the writer turns into capture timestamps.
+    Uploads run on connections of the Snowflake `pool`, so several can be in flight at once.
+    Without a predictor the inference stage is skipped and only the snapshots are uploaded.
+    With STREAM_RECORDINGS the recording isn't downloaded first: snapshots are sampled (and inferred) while it is
+    fetched from its URL, in a single "stream" stage.
+    With a `ledger`, finished events are skipped, a download still on disk is reused and progress is recorded. A step
+    that failed for any snapshot (inference, PUT or row) fails the event, which stays at its last complete stage so
+    the next run retries it.
+    `inference_limiter` (a threading semaphore) caps the endpoint calls of all inference workers together.
+    `snapshot_executor` (e.g. a process pool of `snapshot_workers` processes) decodes recordings instead of the
+    default thread pool. Predictions found in `prediction_cache` are reused instead of calling the endpoint.
+    """
+    pipeline = "process" if predictor is not None else "collect"
+
+    def mark(job, stage, **kwargs):
+        if ledger is not None:
+            ledger.mark(job["recording_id"], pipeline, stage, **kwargs)
+
+    scheduler = DownloadScheduler(client.ring, max_active=DOWNLOAD_CONCURRENCY)
+
+    async def download(event):
+        recording_id, created_at = event["id"], event_time(event)
+        job = {
+            "recording_id": recording_id,
+            "created_at": created_at,
+            "device_name": event.get("device_name", device_name),
+        }
+        if ledger is not None:
+            stage, video_file = ledger.get(recording_id, pipeline)
+            if stage == "uploaded":
+                print(f"[yellow]Recording {recording_id} already {pipeline}ed, skipping[/yellow]")
+                return None
+            if stage == "downloaded" and video_file and Path(video_file).is_file():
+                print(f"Reusing downloaded recording {video_file}")
+                return {**job, "video_file": video_file}
+        if STREAM_RECORDINGS:
+            source = await scheduler.recording_url(recording_id, job["device_name"], created_at)
+            if not source:
+                return None
+            video_url, name = source
+            return {**job, "video_url": video_url, "name": name}
+        video_file = await scheduler.download(recording_id, job["device_name"], created_at=created_at)
+        if not video_file:
+            return None
+        job["video_file"] = video_file
+        mark(job, "downloaded", video_file=video_file)
+        return job
+
+    async def stream(job):
+        if "video_url" in job:
+            print(f"Streaming recording {job['recording_id']} into snapshots")
+            try:
+                job["snapshots"], inference_results = await asyncio.to_thread(
+                    stream_snapshots, job["video_url"], job["name"], predictor, prediction_cache, inference_limiter
+                )
+                _tag_snapshots(job)
+                if inference_results is not None:
+                    job["inference_results"] = inference_results
+                    _check_inference(job)
+                mark(job, "snapshotted" if inference_results is None else "inferred")
+                return job
+            except IOError as e:
+                print(f"[yellow]Could not stream recording {job['recording_id']}, downloading it ({e})[/yellow]")
+                job["video_file"] = await scheduler.download(
+                    job["recording_id"], job["device_name"], created_at=job["created_at"]
+                )
+                if not job["video_file"]:
+                    return None
+        # Fallback download, or a download still on disk from a previous run
+        job = await snapshot(job)
+        return await asyncio.to_thread(infer, job) if predictor is not None else job
+
+    async def snapshot(job):
+        print(f"Parsing video {job['video_file']} into snapshots")
+        loop = asyncio.get_running_loop()
+        if snapshot_executor is None:
+            job["snapshots"] = await loop.run_in_executor(None, extract_snapshots, job["video_file"])
+        else:
+            job["snapshots"], counters = await loop.run_in_executor(
+                snapshot_executor, _extract_snapshots_in_worker, job["video_file"]
+            )
+            metrics.merge_counters(counters)
+        _tag_snapshots(job)
+        mark(job, "snapshotted")
+        return job
+
+    def infer(job):
+        print(f"Running inference on {len(job['snapshots'])} snapshots")
+        job["inference_results"] = run_inference_on_images(
+            job["snapshots"], predictor, cache=prediction_cache, limiter=inference_limiter
+        )
+        _check_inference(job)
+        mark(job, "inferred")
+        return job
+
+    def write(cursor, job):
+        print(f"Uploading {len(job['snapshots'])} snapshots to Snowflake")
+        # Raises SnapshotUploadError if any snapshot didn't reach the stage
+        upload_images_to_snowflake(job["snapshots"], cursor)
+        if "inference_results" in job:
+            print("Uploading inference results to Snowflake")
+            written, failed = upload_inference_results_to_snowflake(job["inference_results"], cursor)
+            if failed:
+                raise RuntimeError(
+                    f"{failed} inference rows of recording {job['recording_id']} failed to write ({written} written)"
+                )
+
+    async def upload(job):
+        await pool.run_async(write, job)
+        mark(job, "uploaded")
+        metrics.inc("events_total", pipeline=pipeline)
+        return job["recording_id"]
+
+    # Download workers mostly wait for recordings to become ready; the scheduler caps the actual downloads
+    stages = [Stage("download", download, concurrency=DOWNLOAD_PENDING_LIMIT, queue_size=PIPELINE_QUEUE_SIZE)]
+    if STREAM_RECORDINGS:
+        stages.append(
+            Stage(
+                "stream",
+                stream,
+                concurrency=SNAPSHOT_CONCURRENCY,
+                queue_size=PIPELINE_QUEUE_SIZE,
+            )
+        )
+    else:
+        stages.append(
+            Stage(
+                "snapshot",
+                snapshot,
+                concurrency=max(SNAPSHOT_CONCURRENCY, snapshot_workers or 0),
+                queue_size=PIPELINE_QUEUE_SIZE,
+            )
+        )
+    if predictor is not None and not STREAM_RECORDINGS:
+        stages.append(
+            Stage(
+                "inference",
+                infer,
+                concurrency=INFERENCE_CONCURRENCY,
+                queue_size=PIPELINE_QUEUE_SIZE,
+            )
+        )
+    # Each upload checks out its own pooled connection; the pool size caps uploads across all pipelines
+    stages.append(Stage("upload", upload, concurrency=UPLOAD_CONCURRENCY, queue_size=PIPELINE_QUEUE_SIZE))
+    return stages
+
+
+async def process_events_last_minutes(device_name=None, minutes=60, workers=None):
+    """
+    Process all Ring events from the last `minutes` minutes, decoding recordings on `workers` processes
+    (default SNAPSHOT_WORKERS, 1 decodes on a thread of this process).
+    """
     print(f"[bold]Processing events from the last {minutes} minutes[/bold]")
-    ring, auth = await get_authenticated_ring()
-    await ring.async_update_data()
+    start_metrics_server()
+    client = await RingClient.connect()
 
-    conn, cursor = get_snowflake_connection_and_cursor()
+    pool = SnowflakePool()
+    ledger = EventLedger()
     predictor = get_predictor()
+    prediction_cache = get_prediction_cache()
+    workers = workers or SNAPSHOT_WORKERS
+    snapshot_executor = get_snapshot_executor(workers)
 
     try:
-        recent_events = await get_recent_events(ring, device_name, minutes=minutes)
+        recent_events = await get_recent_events(client.ring, device_name, minutes=minutes)
         print(f"[bold]Found {len(recent_events)} events in the last {minutes} minutes[/bold]")
 
-        for event in recent_events:
-            recording_id = event["id"]
-            await process_recording_event(ring, auth, recording_id, cursor, predictor, device_name)
-            await asyncio.sleep(2)  # avoid hammering the API
+        pending = [event for event in recent_events if not ledger.is_done(event["id"], "process")]
+        if len(pending) < len(recent_events):
+            print(f"Skipping {len(recent_events) - len(pending)} events already processed")
+        stages = build_event_stages(
+            client,
+            pool,
+            predictor,
+            device_name,
+            ledger=ledger,
+            snapshot_executor=snapshot_executor,
+            snapshot_workers=workers,
+            prediction_cache=prediction_cache,
+        )
+        uploaded = await run_pipeline(pending, stages)
+        print(f"[bold]Processed {len(uploaded)} of {len(pending)} events[/bold]")
 
     finally:
-        await auth.async_close()  # Properly close aiohttp session
-        cursor.close()
-        conn.close()
+        report_metrics("process-events")
+        await client.close()  # Properly close aiohttp session
+        pool.close()
+        ledger.close()
+        if prediction_cache is not None:
+            prediction_cache.close()
+        if snapshot_executor is not None:
+            snapshot_executor.shutdown()
 
 
-async def collect_data_last_minutes(device_name=None, minutes=60):
-    """Download all Ring events from the last `minutes` and upload snapshots to Snowflake (no inference)."""
+async def collect_data_last_minutes(device_name=None, minutes=60, workers=None):
+    """
+    Download all Ring events from the last `minutes` and upload snapshots to Snowflake (no inference), decoding
+    recordings on `workers` processes (default SNAPSHOT_WORKERS, 1 decodes on a thread of this process).
+    """
     print(f"[bold]Collecting data from the last {minutes} minutes (no inference)[/bold]")
-    ring, auth = await get_authenticated_ring()
-    await ring.async_update_data()
+    start_metrics_server()
+    client = await RingClient.connect()
 
-    conn, cursor = get_snowflake_connection_and_cursor()
+    pool = SnowflakePool()
+    ledger = EventLedger()
+    workers = workers or SNAPSHOT_WORKERS
+    snapshot_executor = get_snapshot_executor(workers)
 
     try:
-        recent_events = await get_recent_events(ring, device_name, minutes=minutes)
+        recent_events = await get_recent_events(client.ring, device_name, minutes=minutes)
         print(f"[bold]Found {len(recent_events)} events in the last {minutes} minutes[/bold]")
 
-        for event in recent_events:
-            recording_id = event["id"]
-            video_file = await download_recording(ring, auth, recording_id, device_name)
-            if not video_file:
-                continue
-            print(f"Parsing video {video_file} into snapshots")
-            image_files = video_to_snapshots(video_file)
-            print(f"Uploading {len(image_files)} snapshots to Snowflake")
-            upload_images_to_snowflake(image_files, cursor)
-            await asyncio.sleep(2)  # avoid hammering the API
+        pending = [event for event in recent_events if not ledger.is_done(event["id"], "collect")]
+        if len(pending) < len(recent_events):
+            print(f"Skipping {len(recent_events) - len(pending)} events already collected")
+        stages = build_event_stages(
+            client,
+            pool,
+            device_name=device_name,
+            ledger=ledger,
+            snapshot_executor=snapshot_executor,
+            snapshot_workers=workers,
+        )
+        uploaded = await run_pipeline(pending, stages)
+        print(f"[bold]Collected {len(uploaded)} of {len(pending)} events[/bold]")
 
     finally:
-        await auth.async_close()  # Properly close aiohttp session
-        cursor.close()
-        conn.close()
+        report_metrics("collect-data")
+        await client.close()  # Properly close aiohttp session
+        pool.close()
+        ledger.close()
+        if snapshot_executor is not None:
+            snapshot_executor.shutdown()
+
+
+async def _supervise(name, watch, restart_seconds=30):
+    # Keep one camera's failures from taking the other cameras down with it
+    while True:
+        try:
+            await watch()
+        except Exception as e:
+            print(f"[red]Camera '{name}' stopped: {e}. Restarting in {restart_seconds}s[/red]")
+            await asyncio.sleep(restart_seconds)
+
 
+async def _live_events(sources):
+    """
+    New events of every camera as one async stream, each tagged with its camera's "device_name". Each camera's
+    `HistoryEventSource` polls on its own task, so a busy or failing camera doesn't hold up the others.
+    """
+    events = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
 
-async def event_loop(device_name=None):
+    async def feed(name, source):
+        async for event in source.events():
+            await events.put({**event, "device_name": name})
+
+    feeders = [asyncio.create_task(_supervise(name, partial(feed, name, source))) for name, source in sources.items()]
+    try:
+        while True:
+            yield await events.get()
+    finally:
+        for task in feeders:
+            task.cancel()
+        await asyncio.gather(*feeders, return_exceptions=True)
+
+
+async def event_loop(device_name=None, device_names=None, all_devices=False):
+    """
+    Run the live pipeline for one camera, a list of cameras, or every stickup cam (`all_devices`).
+    Every camera's new events go into one long-lived stage pipeline, so a recording that isn't ready yet waits for
+    its download retry without holding up later events or polling. All cameras share its Ring session, predictor,
+    prediction cache, Snowflake connection pool, ledger and download scheduler (DOWNLOAD_CONCURRENCY downloads at
+    once), and at most GLOBAL_INFERENCE_LIMIT endpoint calls are in flight at once.
+    """
     print("[bold]Starting Ring to Snowflake pipeline[/bold]")
-    ring, auth = await get_authenticated_ring()
-    await ring.async_update_data()
+    start_metrics_server()
+    client = await RingClient.connect()
 
-    conn, cursor = get_snowflake_connection_and_cursor()
+    cam_names = [cam.name for cam in client.devices()["stickup_cams"]]
+    if all_devices:
+        device_names = cam_names
+    elif device_names and len(device_names) > 1:
+        # A single unknown name keeps the old behaviour of falling back to the first camera (see get_stickup_cam)
+        unknown = [name for name in device_names if name not in cam_names]
+        if unknown:
+            print(f"[red]No stickup camera found with name(s) {unknown}, skipping them[/red]")
+        device_names = [name for name in device_names if name in cam_names]
+    elif not device_names:
+        device_names = [device_name]
+    if not device_names:
+        print("[red]No cameras to watch[/red]")
+        await client.close()
+        return
+
+    pool = SnowflakePool()
+    ledger = EventLedger()
     predictor = get_predictor()
+    prediction_cache = get_prediction_cache()
+    inference_limiter = threading.BoundedSemaphore(GLOBAL_INFERENCE_LIMIT)
+    listener = await start_event_listener(client.ring) if RING_PUSH_NOTIFICATIONS else None
+    sources = {name: HistoryEventSource(client.ring, name) for name in device_names}
+    if listener is not None:
+        for source in sources.values():
+            source.attach_listener(listener)
+    print(f"[bold]Watching {len(device_names)} camera(s): {', '.join(map(str, device_names))}[/bold]")
+    metrics_logger = asyncio.create_task(_log_metrics_periodically("run"))
+
+    stages = build_event_stages(
+        client, pool, predictor, ledger=ledger, inference_limiter=inference_limiter, prediction_cache=prediction_cache
+    )
 
     try:
-        previous_id = "-1"
-        while True:
-            previous_id = await check_new_event_and_process(ring, auth, previous_id, cursor, predictor, device_name)
-            await asyncio.sleep(5)
+        await run_pipeline(_live_events(sources), stages, collect=False)
     finally:
-        cursor.close()
-        conn.close()
+        metrics_logger.cancel()
+        if listener is not None:
+            await listener.stop()
+        report_metrics("run")
+        await client.close()
+        pool.close()
+        ledger.close()
+        if prediction_cache is not None:
+            prediction_cache.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,80 @@
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+import threading
+from pathlib import Path
+
+from nestcam.config import IMAGE_CACHE_DIR, IMAGE_CACHE_MAX_MB, snowflake_image_stage
+
+
+class StageImageCache:
+    """
+    Local copies of snapshots on the image stage, so the dashboard fetches each image once instead of on every
+    rerun. Files are stored under a hash of their stage path (stage files are never rewritten under the same name),
+    downloads land in a private temp dir and are moved in atomically, so concurrent sessions never see partial files.
+    The least recently used files are evicted once the cache exceeds `max_mb`. Safe to share between threads.
+    """
+
+    def __init__(self, pool, stage_name: str = None, cache_dir: str = None, max_mb: float = None):
+        self.pool = pool
+        self.stage_name = stage_name or snowflake_image_stage()
+        self.cache_dir = Path(cache_dir or IMAGE_CACHE_DIR)
+        self.max_bytes = int((max_mb or IMAGE_CACHE_MAX_MB) * 1024 * 1024)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+
+    def _path(self, image_path: str):
+        key = hashlib.sha256(f"{self.stage_name}/{image_path}".encode()).hexdigest()
+        return self.cache_dir / f"{key}{Path(image_path).suffix}"
+
+    def _cached(self, image_path: str):
+        path = self._path(image_path)
+        try:
+            os.utime(path)  # mark as recently used
+        except FileNotFoundError:
+            return None
+        return path
+
+    def _fetch(self, image_paths):
+        """GET `image_paths` from the stage in a single command and move them into the cache."""
+        download_dir = Path(tempfile.mkdtemp(prefix="get_", dir=self.cache_dir))
+        try:
+            names = "|".join(re.escape(image_path) for image_path in image_paths)
+            self.pool.run(
+                lambda cursor: cursor.execute(
+                    f"GET @{self.stage_name} 'file://{download_dir.as_posix()}' PATTERN = %s", (f".*({names})",)
+                )
+            )
+            for image_path in image_paths:
+                downloaded = download_dir / Path(image_path).name
+                if downloaded.is_file():
+                    os.replace(downloaded, self._path(image_path))
+        finally:
+            shutil.rmtree(download_dir, ignore_errors=True)
+        self._evict()
+
+    def _evict(self):
+        with self._lock:
+            files = [(entry.stat(), entry) for entry in self.cache_dir.iterdir() if entry.is_file()]
+            total = sum(stat.st_size for stat, _ in files)
+            for stat, entry in sorted(files, key=lambda item: item[0].st_mtime):
+                if total <= self.max_bytes:
+                    break
+                entry.unlink(missing_ok=True)
+                total -= stat.st_size
+
+    def get(self, image_path: str):
+        """Local path of a stage image, downloading it on a cache miss. None if it isn't on the stage."""
+        path = self._cached(image_path)
+        if path is None:
+            self._fetch([image_path])
+            path = self._cached(image_path)
+        return str(path) if path else None
+
+    def prefetch(self, image_paths):
+        """Download every image of `image_paths` that isn't cached yet with one GET, e.g. the latest detections."""
+        missing = [image_path for image_path in dict.fromkeys(image_paths) if self._cached(image_path) is None]
+        if missing:
+            self._fetch(missing)
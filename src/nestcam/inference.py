@@ -1,19 +1,184 @@
-from PIL import Image
-from landingai.predict import SnowflakeNativeAppPredictor
+import io
+import os
+import random
+import threading
+import time
+from contextlib import nullcontext
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from rich import print
+
+from nestcam.config import INFERENCE_RETRIES, INFERENCE_TIMEOUT_SECONDS, INFERENCE_WORKERS
+from nestcam.metrics import metrics
+
+if TYPE_CHECKING:
+    from landingai.predict import SnowflakeNativeAppPredictor
+
+    from nestcam.prediction_cache import PredictionCache
+
+
+def _load_image(image):
+    """RGB array of an in-memory `Snapshot`, or the decoded image at a file path."""
+    if not isinstance(image, (str, os.PathLike)):
+        return image.rgb
+    from PIL import Image
+
+    # Read the file once and decode from memory, instead of keeping a lazy file handle open during the request
+    loaded = Image.open(io.BytesIO(Path(image).read_bytes()))
+    loaded.load()
+    return loaded
+
+
+def _image_name(image):
+    return str(image) if isinstance(image, (str, os.PathLike)) else image.name
+
+
+def create_predictor(timeout: float = None, **kwargs):
+    """
+    A `SnowflakeNativeAppPredictor` (`kwargs` are its arguments) whose HTTP requests time out after `timeout` seconds
+    (default INFERENCE_TIMEOUT_SECONDS) of connecting or waiting for data. A hung endpoint call then fails and ends
+    instead of being abandoned on a thread while a retry runs next to it.
+    """
+    # Imported here so commands without inference (collect-data) don't pay for loading the LandingAI SDK
+    from landingai.predict import SnowflakeNativeAppPredictor
+    from requests.adapters import HTTPAdapter
+
+    timeout = timeout or INFERENCE_TIMEOUT_SECONDS
+
+    class TimeoutAdapter(HTTPAdapter):
+        def send(self, request, **send_kwargs):
+            if send_kwargs.get("timeout") is None:
+                send_kwargs["timeout"] = timeout
+            return super().send(request, **send_kwargs)
+
+    class Predictor(SnowflakeNativeAppPredictor):
+        http_timeout = timeout
+
+        @property
+        def _session(self):
+            # A new session per call (for a fresh auth token). Keep the SDK's retries of refused connections and 5xx,
+            # but not of read timeouts: the request reached the endpoint, and `_predict_with_retry` decides on those
+            session = SnowflakeNativeAppPredictor._session.fget(self)
+            for prefix, adapter in list(session.adapters.items()):
+                session.mount(prefix, TimeoutAdapter(max_retries=adapter.max_retries.new(read=0)))
+            return session
+
+        @_session.setter
+        def _session(self, value):
+            pass
+
+    return Predictor(**kwargs)
+
+
+class InferenceTimeout(TimeoutError):
+    """A predict call outlived its timeout and may still be running (and billed), so it must not be retried."""
+
+
+def _call_with_timeout(func, timeout):
+    """
+    Run `func` on a daemon thread and give up after `timeout` seconds. The abandoned call finishes in the background
+    but never holds up interpreter exit.
+    """
+    outcome = {}
+
+    def call():
+        try:
+            outcome["result"] = func()
+        except BaseException as e:
+            outcome["error"] = e
+
+    thread = threading.Thread(target=call, name="inference-call", daemon=True)
+    thread.start()
+    thread.join(timeout)
+    if thread.is_alive():
+        raise InferenceTimeout(f"Inference call timed out after {timeout}s")
+    if "error" in outcome:
+        raise outcome["error"]
+    return outcome["result"]
+
+
+def _predict_with_retry(predictor, image_source, timeout, retries, backoff_seconds=1.0, limiter=None):
+    image = _load_image(image_source)
+    # With an HTTP timeout (see `create_predictor`) a call is over when it fails, so it can be retried safely;
+    # other predictors are cut off by a watchdog thread, and a call cut off that way is not retried
+    http_timeout = getattr(predictor, "http_timeout", None) is not None
+    for attempt in range(retries + 1):
+        try:
+            # The slot is held for the call only, not for the backoff before a retry
+            with limiter or nullcontext(), metrics.time("inference_seconds"):
+                if http_timeout:
+                    return predictor.predict(image)
+                return _call_with_timeout(lambda: predictor.predict(image), timeout)
+        except InferenceTimeout:
+            metrics.inc("inference_timeouts_total")
+            raise
+        except Exception as e:
+            if attempt == retries:
+                raise
+            metrics.inc("inference_retries_total")
+            # Exponential backoff with full jitter so parallel workers don't retry in lockstep
+            delay = random.uniform(0, backoff_seconds * 2**attempt)
+            print(f"[yellow]Inference failed for {_image_name(image_source)} ({e}), retrying in {delay:.1f}s[/yellow]")
+            time.sleep(delay)
 
 
 def run_inference_on_images(
-    image_files: list[str], predictor: SnowflakeNativeAppPredictor
+    images,
+    predictor: "SnowflakeNativeAppPredictor",
+    workers: int = None,
+    timeout: float = None,
+    retries: int = None,
+    cache: "PredictionCache" = None,
+    limiter: threading.Semaphore = None,
 ):
-    results = []
-    for image_path in image_files:
-        image = Image.open(image_path)
-        predictions = predictor.predict(image)
-        results.append(
-            {
-                "file": image_path,
-                "endpoint_id": predictor._endpoint_id,
-                "predictions": predictions,
-            }
-        )
+    """
+    Run `predictor` on every image (file path or in-memory `Snapshot`) with a pool of `workers` concurrent calls.
+    `images` may be an iterator, e.g. snapshots of a recording that is still being decoded: each image is submitted
+    as soon as it is yielded. Results are returned in input order; images that still fail after `retries` get empty
+    predictions and an "error" entry, which the writer counts as failed rather than as an image without detections.
+    With a `cache`, images the endpoint already predicted are answered from it without a call, identical images of
+    the batch share one call, and new predictions are stored. `limiter` is a semaphore shared with other batches
+    (e.g. of other cameras) that caps their combined endpoint calls.
+    """
+    workers = workers or INFERENCE_WORKERS
+    timeout = timeout or INFERENCE_TIMEOUT_SECONDS
+    retries = INFERENCE_RETRIES if retries is None else retries
+    endpoint_id = predictor._endpoint_id
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        submitted = []
+        in_flight = {}  # image key -> future of its call
+        for image in images:
+            key = cache.key(image) if cache is not None else None
+            cached = cache.get(endpoint_id, key) if key is not None else None
+            if cached is not None:
+                metrics.inc("prediction_cache_hits_total")
+                future = Future()
+                future.set_result(cached)
+            elif key is not None and key in in_flight:
+                metrics.inc("prediction_cache_hits_total")
+                future = in_flight[key]
+            else:
+                if key is not None:
+                    metrics.inc("prediction_cache_misses_total")
+                future = executor.submit(_predict_with_retry, predictor, image, timeout, retries, limiter=limiter)
+                if key is not None:
+                    in_flight[key] = future
+            submitted.append((image, key, future))
+        results = []
+        for image, key, future in submitted:
+            result = {"file": _image_name(image), "endpoint_id": endpoint_id, "predictions": []}
+            if not isinstance(image, (str, os.PathLike)):
+                result["snapshot"] = image
+            try:
+                result["predictions"] = future.result()
+                metrics.inc("images_inferred_total")
+                if key is not None and in_flight.pop(key, None) is future:
+                    cache.put(endpoint_id, key, result["predictions"])
+            except Exception as e:
+                print(f"[red]Inference failed for {result['file']}: {e}[/red]")
+                result["error"] = str(e)
+                metrics.inc("inference_failures_total")
+            results.append(result)
     return results
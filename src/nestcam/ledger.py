@@ -0,0 +1,68 @@
+import sqlite3
+import threading
+from datetime import datetime, timezone
+from pathlib import Path
+
+from nestcam.config import LEDGER_PATH
+
+# Stages a recording goes through, in order. "uploaded" means the event is done for that pipeline.
+STAGES = ("downloaded", "snapshotted", "inferred", "uploaded")
+
+
+class EventLedger:
+    """
+    Durable record (SQLite) of how far each recording got in each pipeline ("process" or "collect"), so that
+    restarts and overlapping runs skip finished events and reuse a download that is still on disk.
+    Safe to use from the executor threads the pipeline stages run on.
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path or LEDGER_PATH
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS events (
+                    recording_id TEXT NOT NULL,
+                    pipeline TEXT NOT NULL,
+                    stage TEXT NOT NULL,
+                    video_file TEXT,
+                    updated_at TEXT NOT NULL,
+                    PRIMARY KEY (recording_id, pipeline)
+                )
+                """)
+
+    def get(self, recording_id, pipeline: str):
+        """(stage, video_file) of a recording, or (None, None) if it was never seen."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT stage, video_file FROM events WHERE recording_id = ? AND pipeline = ?",
+                (str(recording_id), pipeline),
+            ).fetchone()
+        return row if row else (None, None)
+
+    def stage(self, recording_id, pipeline: str):
+        return self.get(recording_id, pipeline)[0]
+
+    def is_done(self, recording_id, pipeline: str):
+        return self.stage(recording_id, pipeline) == STAGES[-1]
+
+    def mark(self, recording_id, pipeline: str, stage: str, video_file: str = None):
+        if stage not in STAGES:
+            raise ValueError(f"Unknown stage '{stage}', expected one of {STAGES}")
+        with self._lock, self._conn:
+            self._conn.execute(
+                """
+                INSERT INTO events (recording_id, pipeline, stage, video_file, updated_at) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (recording_id, pipeline) DO UPDATE SET
+                    stage = excluded.stage,
+                    video_file = COALESCE(excluded.video_file, events.video_file),
+                    updated_at = excluded.updated_at
+                """,
+                (str(recording_id), pipeline, stage, video_file, datetime.now(timezone.utc).isoformat()),
+            )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
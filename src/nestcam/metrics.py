@@ -0,0 +1,212 @@
+import json
+import statistics
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+# Upper bounds (seconds) of the latency histogram buckets, from a fast Snowflake insert to a slow recording download
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+class LatencyRecorder:
+    """Keeps the most recent `maxlen` call durations per operation name (thread-safe)."""
+
+    def __init__(self, maxlen: int = 1000):
+        self._samples = defaultdict(lambda: deque(maxlen=maxlen))
+        self._lock = threading.Lock()
+
+    def record(self, name: str, seconds: float):
+        with self._lock:
+            self._samples[name].append(seconds)
+
+    @contextmanager
+    def time(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def summary(self):
+        """{name: {"count", "mean_ms", "p50_ms", "p95_ms", "max_ms"}} over the recorded samples."""
+        with self._lock:
+            samples = {name: sorted(values) for name, values in self._samples.items() if values}
+        return {
+            name: {
+                "count": len(values),
+                "mean_ms": statistics.fmean(values) * 1000,
+                "p50_ms": values[len(values) // 2] * 1000,
+                "p95_ms": values[min(len(values) - 1, int(len(values) * 0.95))] * 1000,
+                "max_ms": values[-1] * 1000,
+            }
+            for name, values in samples.items()
+        }
+
+    def reset(self):
+        with self._lock:
+            self._samples.clear()
+
+
+def _labels(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _series(name, labels, extra=()):
+    """Prometheus series name, e.g. stage_seconds{stage="download"}"""
+    pairs = list(labels) + list(extra)
+    return name + ("{" + ",".join(f'{key}="{value}"' for key, value in pairs) + "}" if pairs else "")
+
+
+class Metrics:
+    """
+    Counters, gauges and latency histograms of one process, each identified by a name plus optional labels
+    (e.g. `metrics.inc("rows_written_total", 10, method="insert")`). Histograms are cumulative for Prometheus;
+    `summary()` reports percentiles over the most recent samples. Thread-safe.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, maxlen: int = 1000):
+        self.buckets = tuple(buckets)
+        self.latencies = LatencyRecorder(maxlen)
+        self._counters = defaultdict(float)
+        self._gauges = {}
+        self._histograms = {}  # (name, labels) -> [per-bucket counts + overflow, sum, count]
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1, **labels):
+        with self._lock:
+            self._counters[(name, _labels(labels))] += value
+
+    def set_gauge(self, name: str, value: float, **labels):
+        with self._lock:
+            self._gauges[(name, _labels(labels))] = value
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = (name, _labels(labels))
+        self.latencies.record(_series(*key), seconds)
+        with self._lock:
+            histogram = self._histograms.setdefault(key, [[0] * (len(self.buckets) + 1), 0.0, 0])
+            index = next((i for i, bound in enumerate(self.buckets) if seconds <= bound), len(self.buckets))
+            histogram[0][index] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    @contextmanager
+    def time(self, name: str, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def counters(self):
+        """{(name, labels): value}, e.g. to send the counters of a worker process back to the parent."""
+        with self._lock:
+            return dict(self._counters)
+
+    def merge_counters(self, counters):
+        with self._lock:
+            for key, value in counters.items():
+                self._counters[key] += value
+
+    def summary(self):
+        """{"counters", "gauges", "latencies"} keyed by series name, as written to the JSON-lines log."""
+        with self._lock:
+            counters = {_series(*key): value for key, value in sorted(self._counters.items())}
+            gauges = {_series(*key): value for key, value in sorted(self._gauges.items())}
+        return {"counters": counters, "gauges": gauges, "latencies": self.latencies.summary()}
+
+    def to_prometheus(self):
+        """All metrics in the Prometheus text exposition format."""
+        with self._lock:
+            counters = sorted(self._counters.items())
+            gauges = sorted(self._gauges.items())
+            histograms = sorted(
+                (key, ([*counts], total, count)) for key, (counts, total, count) in self._histograms.items()
+            )
+        lines = []
+        typed = set()
+
+        def type_line(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE nestcam_{name} {kind}")
+
+        for (name, labels), value in counters:
+            type_line(name, "counter")
+            lines.append(f"nestcam_{_series(name, labels)} {value:g}")
+        for (name, labels), value in gauges:
+            type_line(name, "gauge")
+            lines.append(f"nestcam_{_series(name, labels)} {value:g}")
+        for (name, labels), (counts, total, count) in histograms:
+            type_line(name, "histogram")
+            cumulative = 0
+            for bound, bucket_count in zip([*self.buckets, "+Inf"], counts):
+                cumulative += bucket_count
+                lines.append(f"nestcam_{_series(name + '_bucket', labels, [('le', bound)])} {cumulative}")
+            lines.append(f"nestcam_{_series(name + '_sum', labels)} {total:g}")
+            lines.append(f"nestcam_{_series(name + '_count', labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def write_jsonl(self, path: str, **fields):
+        """Append the current summary (plus `fields`, e.g. the command) as one JSON line to `path`."""
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        record = {"time": datetime.now(timezone.utc).isoformat(), **fields, **self.summary()}
+        with open(path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._histograms.clear()
+        self.latencies.reset()
+
+
+# The process-wide registry the pipeline modules record into
+metrics = Metrics()
+
+
+def serve_prometheus(port: int, registry: Metrics = None):
+    """Serve `registry` (default: `metrics`) at http://0.0.0.0:<port>/metrics from a daemon thread."""
+    registry = registry or metrics
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = registry.to_prometheus().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("", port), Handler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
+
+
+def read_jsonl(path: str):
+    """Records of a metrics log, oldest first."""
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def format_summary(summary):
+    """Human-readable lines for a `Metrics.summary()` (or a record of the JSON-lines log)."""
+    lines = []
+    for name, stats in sorted(summary.get("latencies", {}).items()):
+        lines.append(
+            f"{name}: {stats['count']} calls, mean {stats['mean_ms']:.0f} ms, p50 {stats['p50_ms']:.0f} ms, "
+            f"p95 {stats['p95_ms']:.0f} ms, max {stats['max_ms']:.0f} ms"
+        )
+    for name, value in summary.get("counters", {}).items():
+        lines.append(f"{name}: {value:g}")
+    for name, value in summary.get("gauges", {}).items():
+        lines.append(f"{name}: {value:g} (gauge)")
+    return lines
@@ -0,0 +1,95 @@
+import asyncio
+import inspect
+from functools import partial
+
+from rich import print
+
+from nestcam.metrics import metrics
+
+
+class Stage:
+    """
+    One step of a pipeline. `func` takes an item and returns the item for the next stage, or None to drop it.
+    Coroutine functions run on the event loop, plain functions run on `executor` (default thread pool).
+    When its input queue is full, the upstream stage waits (backpressure), so no item is ever dropped.
+    """
+
+    def __init__(self, name, func, concurrency=1, queue_size=4, executor=None):
+        if concurrency < 1:
+            raise ValueError("Stage concurrency must be at least 1")
+        self.name = name
+        self.func = func
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.executor = executor
+
+    async def call(self, item):
+        with metrics.time("stage_seconds", stage=self.name):
+            if inspect.iscoroutinefunction(self.func):
+                return await self.func(item)
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, partial(self.func, item))
+
+    async def put(self, queue, item):
+        await queue.put(item)
+        metrics.set_gauge("queue_depth", queue.qsize(), stage=self.name)
+
+
+async def _worker(stage, inbox, next_stage, outbox, results):
+    while True:
+        item = await inbox.get()
+        metrics.set_gauge("queue_depth", inbox.qsize(), stage=stage.name)
+        try:
+            output = await stage.call(item)
+            metrics.inc("stage_items_total", stage=stage.name, outcome="ok" if output is not None else "skipped")
+        except Exception as e:
+            metrics.inc("stage_items_total", stage=stage.name, outcome="failed")
+            print(f"[red]Stage '{stage.name}' failed: {e}[/red]")
+            output = None
+        try:
+            if output is None:
+                continue
+            if outbox is None:
+                if results is not None:
+                    results.append(output)
+            else:
+                await next_stage.put(outbox, output)
+        finally:
+            inbox.task_done()
+
+
+async def run_pipeline(items, stages, collect=True):
+    """
+    Push `items` through `stages`, with a bounded queue in front of every stage so that all stages run concurrently
+    on different items. `items` may also be an async iterable, e.g. live events, which is consumed as it produces
+    them; a full first queue pauses it. Returns the non-None outputs of the last stage (in completion order), or
+    nothing without `collect` (for a pipeline that runs indefinitely).
+    """
+    queues = [asyncio.Queue(maxsize=stage.queue_size) for stage in stages]
+    results = []
+    workers = []
+    for i, stage in enumerate(stages):
+        next_stage, outbox = (stages[i + 1], queues[i + 1]) if i + 1 < len(stages) else (None, None)
+        workers.append(
+            [
+                asyncio.create_task(_worker(stage, queues[i], next_stage, outbox, results if collect else None))
+                for _ in range(stage.concurrency)
+            ]
+        )
+    try:
+        if hasattr(items, "__aiter__"):
+            async for item in items:
+                await stages[0].put(queues[0], item)
+        else:
+            for item in items:
+                await stages[0].put(queues[0], item)
+        # Drain stage by stage: once a stage's queue is joined, everything it produced is queued downstream
+        for queue, stage_workers in zip(queues, workers):
+            await queue.join()
+            for task in stage_workers:
+                task.cancel()
+    finally:
+        for task in (task for stage_workers in workers for task in stage_workers):
+            task.cancel()
+        await asyncio.gather(*(task for stage_workers in workers for task in stage_workers), return_exceptions=True)
+    return results if collect else None
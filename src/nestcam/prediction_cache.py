@@ -0,0 +1,135 @@
+import hashlib
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+import cv2
+
+from nestcam.config import (
+    PREDICTION_CACHE_KEY,
+    PREDICTION_CACHE_MAX_AGE_DAYS,
+    PREDICTION_CACHE_MAX_ENTRIES,
+    PREDICTION_CACHE_PATH,
+)
+from nestcam.video_utils import perceptual_hash
+
+KEY_METHODS = ("sha256", "phash")
+# Evict expired and least recently used entries after this many new ones (and when the cache is opened or closed)
+PRUNE_EVERY = 100
+
+
+class PredictionCache:
+    """
+    Durable record (SQLite) of the predictions an endpoint returned for an image, so re-running overlapping windows
+    or a static scene doesn't pay for the same inference call twice. Images are keyed by the SHA-256 of their bytes
+    (key="sha256") or by their perceptual hash (key="phash"), always together with the endpoint id, so deploying a
+    new endpoint invalidates every entry. Entries older than `max_age_days` are misses and get removed, and the
+    least recently used ones are evicted beyond `max_entries`. Safe to use from the inference threads.
+    """
+
+    def __init__(self, path: str = None, key: str = None, max_entries: int = None, max_age_days: float = None):
+        self.path = path or PREDICTION_CACHE_PATH
+        self.method = key or PREDICTION_CACHE_KEY
+        if self.method not in KEY_METHODS:
+            raise ValueError(f"Unknown prediction cache key '{self.method}', expected one of {KEY_METHODS}")
+        self.max_entries = max_entries or PREDICTION_CACHE_MAX_ENTRIES
+        self.max_age_seconds = (max_age_days or PREDICTION_CACHE_MAX_AGE_DAYS) * 86400
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._added = 0
+        with self._lock, self._conn:
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS predictions (
+                    endpoint_id TEXT NOT NULL,
+                    image_key TEXT NOT NULL,
+                    predictions BLOB NOT NULL,
+                    created_at REAL NOT NULL,
+                    used_at REAL NOT NULL,
+                    PRIMARY KEY (endpoint_id, image_key)
+                )
+                """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS predictions_used_at ON predictions (used_at)")
+        self.prune()
+
+    def key(self, image):
+        """Cache key of an image: a file path or an in-memory `Snapshot`."""
+        if isinstance(image, (str, os.PathLike)):
+            if self.method == "phash":
+                return perceptual_hash(cv2.imread(str(image)))
+            return hashlib.sha256(Path(image).read_bytes()).hexdigest()
+        if self.method == "phash":
+            return perceptual_hash(image.image)
+        return hashlib.sha256(image.jpeg).hexdigest()
+
+    def get(self, endpoint_id: str, image_key: str):
+        """Predictions stored for the image, or None on a miss."""
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT predictions FROM predictions WHERE endpoint_id = ? AND image_key = ? AND created_at >= ?",
+                (endpoint_id, image_key, now - self.max_age_seconds),
+            ).fetchone()
+            if row is None:
+                return None
+            try:
+                predictions = pickle.loads(row[0])
+            except Exception:
+                # Written by an incompatible version of the prediction classes
+                self._conn.execute(
+                    "DELETE FROM predictions WHERE endpoint_id = ? AND image_key = ?", (endpoint_id, image_key)
+                )
+                return None
+            self._conn.execute(
+                "UPDATE predictions SET used_at = ? WHERE endpoint_id = ? AND image_key = ?",
+                (now, endpoint_id, image_key),
+            )
+        return predictions
+
+    def put(self, endpoint_id: str, image_key: str, predictions):
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                """
+                INSERT INTO predictions (endpoint_id, image_key, predictions, created_at, used_at)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (endpoint_id, image_key) DO UPDATE SET
+                    predictions = excluded.predictions,
+                    created_at = excluded.created_at,
+                    used_at = excluded.used_at
+                """,
+                (endpoint_id, image_key, pickle.dumps(predictions), now, now),
+            )
+            self._added += 1
+            prune = self._added % PRUNE_EVERY == 0
+        if prune:
+            self.prune()
+
+    def prune(self):
+        """Remove expired entries and the least recently used ones beyond `max_entries`. Returns how many."""
+        with self._lock, self._conn:
+            expired = self._conn.execute(
+                "DELETE FROM predictions WHERE created_at < ?", (time.time() - self.max_age_seconds,)
+            ).rowcount
+            evicted = self._conn.execute(
+                """
+                DELETE FROM predictions WHERE rowid IN (
+                    SELECT rowid FROM predictions ORDER BY used_at DESC LIMIT -1 OFFSET ?
+                )
+                """,
+                (self.max_entries,),
+            ).rowcount
+        return expired + evicted
+
+    def close(self):
+        self.prune()
+        with self._lock:
+            self._conn.close()
+
+
+def get_prediction_cache():
+    """The prediction cache at PREDICTION_CACHE_PATH, or None when it is disabled (empty path)."""
+    return PredictionCache() if PREDICTION_CACHE_PATH else None
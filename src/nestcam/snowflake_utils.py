@@ -1,35 +1,267 @@
+import asyncio
+import io
 import json
 import os
-from datetime import datetime
+import queue
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from functools import partial
 from pathlib import Path
 
 import snowflake.connector
 from rich import print
 
-from nestcam.config import SNOWFLAKE_CONFIG, SNOWFLAKE_IMAGE_STAGE, SNOWFLAKE_INFERENCE_TABLE
+from nestcam.config import (
+    DETECTIONS_LABEL,
+    DETECTIONS_TABLE,
+    DETECTIONS_TARGET_LAG,
+    INFERENCE_WRITE_METHOD,
+    INSERT_CHUNK_ROWS,
+    PUT_PARALLEL,
+    SNOWFLAKE_HEALTH_CHECK_SECONDS,
+    SNOWFLAKE_POOL_SIZE,
+    snowflake_config,
+    snowflake_image_stage,
+    snowflake_inference_table,
+)
+from nestcam.metrics import metrics
+
+# PUT reports these per file once the file is on the stage (SKIPPED = identical file already there)
+PUT_OK_STATUSES = ("UPLOADED", "SKIPPED")
+
+INFERENCE_COLUMNS = (
+    "filename",
+    "endpoint_id",
+    "captured_at",
+    "frame_index",
+    "label_name",
+    "label_index",
+    "confidence",
+    "bboxes",
+    "id",
+    "event_id",
+)
+INFERENCE_WRITE_METHODS = ("insert", "copy")
+
+# Error numbers of an expired session / token (390110-390114) and of a connection that was closed under us
+SESSION_EXPIRED_ERRNOS = (390110, 390112, 390114, 250002)
 
 
 def get_snowflake_connection_and_cursor(config: dict = None):
-    config = config or SNOWFLAKE_CONFIG
+    config = config or snowflake_config()
     conn = snowflake.connector.connect(**config)
     cursor = conn.cursor()
     return conn, cursor
 
 
-def upload_images_to_snowflake(file_paths, cursor, stage_name: str = None):
-    stage_name = stage_name or SNOWFLAKE_IMAGE_STAGE
-    for file_path in file_paths:
+def _is_session_expired(error):
+    return getattr(error, "errno", None) in SESSION_EXPIRED_ERRNOS
+
+
+class SnowflakePool:
+    """
+    Up to `size` Snowflake connections shared by the threads of a long-running process.
+    A connection idle for more than `health_check_seconds` is checked with a query before it is handed out, and
+    one whose session expired is replaced, so `nestcam run` survives the session token expiring overnight.
+    `run_async` runs a query function on the pool's own threads so uploads overlap without blocking the event loop.
+    """
+
+    def __init__(self, config: dict = None, size: int = None, health_check_seconds: float = None):
+        self.config = config or snowflake_config()
+        self.size = size or SNOWFLAKE_POOL_SIZE
+        self.health_check_seconds = (
+            SNOWFLAKE_HEALTH_CHECK_SECONDS if health_check_seconds is None else health_check_seconds
+        )
+        # Most recently used first, so idle connections beyond the current load are the ones that go stale
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(self.size)
+        self._executor = ThreadPoolExecutor(max_workers=self.size, thread_name_prefix="snowflake")
+        self._closed = False
+
+    def _connect(self):
+        config = {k: v for k, v in self.config.items() if v is not None}
+        return snowflake.connector.connect(client_session_keep_alive=True, **config)
+
+    def _healthy(self, conn, last_used: float):
+        if conn.is_closed():
+            return False
+        if time.monotonic() - last_used < self.health_check_seconds:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            return True
+        except Exception as e:
+            print(f"[yellow]Snowflake connection failed its health check ({e}), reconnecting[/yellow]")
+            return False
+
+    @staticmethod
+    def _discard(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _checkout(self):
+        while True:
+            try:
+                conn, last_used = self._idle.get_nowait()
+            except queue.Empty:
+                return self._connect()
+            if self._healthy(conn, last_used):
+                return conn
+            self._discard(conn)
+
+    @contextmanager
+    def connection(self):
+        """A healthy connection for the duration of the block; blocks while all `size` connections are in use."""
+        if self._closed:
+            raise RuntimeError("Snowflake pool is closed")
+        self._slots.acquire()
+        conn = None
+        try:
+            conn = self._checkout()
+            yield conn
+        except Exception as e:
+            if conn is not None and _is_session_expired(e):
+                self._discard(conn)
+                conn = None
+            raise
+        finally:
+            if conn is not None:
+                self._idle.put((conn, time.monotonic()))
+            self._slots.release()
+
+    def run(self, func, *args, **kwargs):
+        """
+        Call `func(cursor, *args, **kwargs)` with a cursor of a pooled connection and return its result.
+        If the session expired mid-call, the call is retried once on a fresh connection.
+        """
+        for attempt in range(2):
+            try:
+                with self.connection() as conn, conn.cursor() as cursor:
+                    return func(cursor, *args, **kwargs)
+            except Exception as e:
+                if attempt or not _is_session_expired(e):
+                    raise
+                print(f"[yellow]Snowflake session expired ({e}), retrying on a new connection[/yellow]")
+
+    async def run_async(self, func, *args, **kwargs):
+        """`run` on one of the pool's threads."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, partial(self.run, func, *args, **kwargs))
+
+    async def execute_async(self, query: str, params=None):
+        """Run one query and return all its rows."""
+        return await self.run_async(lambda cursor: cursor.execute(query, params).fetchall())
+
+    def close(self):
+        self._closed = True
+        self._executor.shutdown()
+        while True:
+            try:
+                conn, _ = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(conn)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class SnapshotUploadError(Exception):
+    """Some snapshots did not reach the image stage; `failed` holds their names, so the caller can retry them."""
+
+    def __init__(self, failed):
+        self.failed = failed
+        super().__init__(f"{len(failed)} snapshots were not uploaded: {failed}")
+
+
+def _is_file(image):
+    return isinstance(image, (str, os.PathLike))
+
+
+def upload_images_to_snowflake(images, cursor, stage_name: str = None, bulk: bool = True, parallel: int = None):
+    """
+    Upload snapshots (file paths or in-memory `Snapshot`s) to the image stage and delete the local files.
+    With `bulk` they are gathered in one temp directory and sent with a single wildcard PUT; otherwise
+    in-memory snapshots are streamed one PUT each without touching the disk.
+    Raises `SnapshotUploadError` if the stage did not accept every snapshot; failed files stay at their paths.
+    """
+    stage_name = stage_name or snowflake_image_stage()
+    if bulk:
+        return _bulk_upload_images(images, cursor, stage_name, parallel or PUT_PARALLEL)
+    for image in images:
+        if not _is_file(image):
+            print(f"Uploading {image.name} to Snowflake stage {stage_name}")
+            with metrics.time("snowflake_seconds", op="put"):
+                cursor.execute(
+                    f"PUT file://{image.name} @{stage_name} AUTO_COMPRESS=FALSE", file_stream=io.BytesIO(image.jpeg)
+                )
+            metrics.inc("upload_bytes_total", len(image.jpeg))
+            metrics.inc("snapshots_uploaded_total")
+            continue
+        file_path = image
         put_command = f"PUT file://{file_path} @{stage_name} AUTO_COMPRESS=FALSE"
         print(f"Uploading {file_path} to Snowflake stage {stage_name}")
-        cursor.execute(put_command)
+        with metrics.time("snowflake_seconds", op="put"):
+            cursor.execute(put_command)
+        metrics.inc("upload_bytes_total", os.path.getsize(file_path))
+        metrics.inc("snapshots_uploaded_total")
         os.remove(file_path)
 
 
+def _put_statuses(cursor):
+    """Map source filename -> status from the result set of a PUT."""
+    columns = [desc[0].lower() for desc in cursor.description]
+    source, status = columns.index("source"), columns.index("status")
+    return {row[source]: row[status] for row in cursor.fetchall()}
+
+
+def _bulk_upload_images(images, cursor, stage_name: str, parallel: int):
+    if not images:
+        return
+    # Files are moved next to where they are; in-memory snapshots are spooled to the system temp dir
+    batch_dir = Path(tempfile.mkdtemp(prefix="put_", dir=Path(images[0]).parent if _is_file(images[0]) else None))
+    sources = {}
+    for image in images:
+        if _is_file(image):
+            sources[Path(image).name] = image
+            shutil.move(image, batch_dir / Path(image).name)
+        else:
+            (batch_dir / image.name).write_bytes(image.jpeg)
+    print(f"Uploading {len(images)} snapshots to Snowflake stage {stage_name} (PARALLEL={parallel})")
+    with metrics.time("snowflake_seconds", op="put"):
+        cursor.execute(f"PUT 'file://{batch_dir.as_posix()}/*' @{stage_name} AUTO_COMPRESS=FALSE PARALLEL={parallel}")
+    statuses = _put_statuses(cursor)
+    failed = [name for name in os.listdir(batch_dir) if statuses.get(name) not in PUT_OK_STATUSES]
+    metrics.inc("upload_bytes_total", sum(entry.stat().st_size for entry in batch_dir.iterdir()))
+    metrics.inc("snapshots_uploaded_total", len(images) - len(failed))
+    metrics.inc("snapshots_upload_failed_total", len(failed))
+    # Failed files go back where they came from, so the caller can upload them again; spooled snapshots are still
+    # in memory
+    for name in failed:
+        if name in sources:
+            shutil.move(batch_dir / name, sources[name])
+    shutil.rmtree(batch_dir)
+    if failed:
+        raise SnapshotUploadError(failed)
+
+
 def _parse_date_and_event_id(file_path: str):
     """
-    Extracts event_id and (year, month, day, hour, minute, second) from a filename containing an event_id and a timestamp in the format YYYYMMDDHHMMSS.
+    Extracts event_id and the UTC timestamp (format YYYYMMDDHHMMSS) from a snapshot filename, for results of
+    snapshot files that carry no event metadata.
     Example filename: FrontDoor_7502087232390641204_20250508145117_2.jpg
-    Returns: (event_id: str, year: int, month: int, day: int, hour: int, minute: int, second: int)
+    Returns: (event_id: str, timestamp: datetime)
     """
     filename = Path(file_path).name
     parts = filename.split("_")
@@ -38,41 +270,264 @@ def _parse_date_and_event_id(file_path: str):
     # device_id = parts[0]
     event_id = parts[1]
     timestamp = parts[2]
-    dt = datetime.strptime(timestamp, "%Y%m%d%H%M%S")
-    return event_id, dt.year, dt.month, dt.day, dt.hour, dt.minute, dt.second
+    return event_id, datetime.strptime(timestamp, "%Y%m%d%H%M%S").replace(tzinfo=timezone.utc)
+
+
+def _capture_metadata(result):
+    """(event_id, captured_at, frame_index) of an inference result, from its snapshot when it has event metadata."""
+    snapshot = result.get("snapshot")
+    if snapshot is not None and snapshot.event_time is not None:
+        return snapshot.event_id, snapshot.captured_at, snapshot.frame_index
+    event_id, captured_at = _parse_date_and_event_id(result["file"])
+    return event_id, captured_at, snapshot.frame_index if snapshot is not None else None
 
 
-def upload_inference_results_to_snowflake(inference_results, cursor, table_name: str = None):
-    table_name = table_name or SNOWFLAKE_INFERENCE_TABLE
+def _inference_rows(inference_results):
+    """Flatten inference results into one row dict per prediction. Returns (rows, number of results that failed)."""
+    rows = []
+    failed = 0
     for result in inference_results:
         try:
             file_path = result["file"]
             filename = Path(file_path).name
+            if "error" in result:
+                # Inference failed for this image: it has no predictions, but that doesn't mean no detections
+                failed += 1
+                continue
 
             endpoint_id = result.get("endpoint_id", "")
             predictions = result.get("predictions", [])
 
-            event_id, year, month, day, hour, minute, second = _parse_date_and_event_id(file_path)
+            event_id, captured_at, frame_index = _capture_metadata(result)
 
             # Ensure predictions is always a list
             if not isinstance(predictions, list):
                 predictions = [predictions]
             for obj in predictions:
                 try:
-                    bboxes_json = json.dumps(obj.bboxes)
-                    insert_query = f"""
-                        INSERT INTO {table_name} (
-                            filename, endpoint_id, DT_year, DT_month, DT_day, DT_hour, DT_minute, DT_second,
-                            label_name, label_index, confidence, bboxes, id, event_id
-                        )
-                        SELECT
-                            '{filename}', '{endpoint_id}', {year}, {month}, {day}, {hour}, {minute}, {second},
-                            '{obj.label_name}', {obj.label_index}, {obj.score}, PARSE_JSON('{bboxes_json}'), '{obj.id}', '{event_id}'
-                    """
-                    cursor.execute(insert_query)
+                    rows.append(
+                        {
+                            "filename": filename,
+                            "endpoint_id": endpoint_id,
+                            "captured_at": captured_at.isoformat(),
+                            "frame_index": frame_index,
+                            "label_name": obj.label_name,
+                            "label_index": obj.label_index,
+                            "confidence": obj.score,
+                            "bboxes": list(obj.bboxes),
+                            "id": obj.id,
+                            "event_id": event_id,
+                        }
+                    )
                 except Exception as e:
-                    print(f"[red]Failed to insert prediction for {filename}: {e}[/red]")
+                    failed += 1
+                    print(f"[red]Failed to read prediction for {filename}: {e}[/red]")
         except KeyError as e:
+            failed += 1
             print(f"[red]Missing expected key in inference result: {e}[/red]")
         except Exception as e:
+            failed += 1
             print(f"[red]Unexpected error processing inference result: {e}[/red]")
+    return rows, failed
+
+
+def _insert_rows(rows, cursor, table_name: str, chunk_rows: int):
+    """Write rows with one bound multi-row INSERT ... SELECT ... FROM VALUES per chunk. Returns (written, failed)."""
+    conversions = {"bboxes": "PARSE_JSON", "captured_at": "TO_TIMESTAMP_TZ"}
+    select = ", ".join(
+        f"{conversions[column]}(column{i})" if column in conversions else f"column{i}"
+        for i, column in enumerate(INFERENCE_COLUMNS, start=1)
+    )
+    row_placeholder = "(" + ", ".join(["%s"] * len(INFERENCE_COLUMNS)) + ")"
+    written = failed = 0
+    for start in range(0, len(rows), chunk_rows):
+        chunk = rows[start : start + chunk_rows]
+        params = [
+            json.dumps(row[column]) if column == "bboxes" else row[column]
+            for row in chunk
+            for column in INFERENCE_COLUMNS
+        ]
+        query = (
+            f"INSERT INTO {table_name} ({', '.join(INFERENCE_COLUMNS)}) "
+            f"SELECT {select} FROM VALUES {', '.join([row_placeholder] * len(chunk))}"
+        )
+        try:
+            cursor.execute(query, params)
+            written += len(chunk)
+        except Exception as e:
+            if _is_session_expired(e):
+                raise
+            failed += len(chunk)
+            print(f"[red]Failed to insert {len(chunk)} inference rows into {table_name}: {e}[/red]")
+    return written, failed
+
+
+def _delete_rows(inference_results, cursor, table_name: str, chunk_rows: int):
+    """
+    Delete the rows already written for the snapshots of `inference_results` (same endpoint and filename), so that
+    writing them again, after an expired session or in a retried event, replaces rows instead of duplicating them.
+    """
+    filenames = {}
+    for result in inference_results:
+        if "error" not in result and "file" in result:
+            filenames.setdefault(result.get("endpoint_id", ""), []).append(Path(result["file"]).name)
+    for endpoint_id, names in filenames.items():
+        for start in range(0, len(names), chunk_rows):
+            chunk = names[start : start + chunk_rows]
+            cursor.execute(
+                f"DELETE FROM {table_name} WHERE endpoint_id = %s AND filename IN ({', '.join(['%s'] * len(chunk))})",
+                [endpoint_id, *chunk],
+            )
+
+
+def _table_stage(table_name: str):
+    """The table stage of a (possibly qualified) table name, e.g. DB.SCHEMA.T -> @DB.SCHEMA.%T"""
+    *qualifier, table = table_name.split(".")
+    return "@" + ".".join(qualifier + [f"%{table}"])
+
+
+def _copy_rows(rows, cursor, table_name: str):
+    """Write rows as an NDJSON file to the table stage and load it with COPY INTO. Returns (written, failed)."""
+    with tempfile.NamedTemporaryFile("w", prefix="inference_", suffix=".ndjson", delete=False) as f:
+        for row in rows:
+            f.write(json.dumps(row) + "\n")
+        ndjson_path = Path(f.name)
+    try:
+        stage = _table_stage(table_name)
+        cursor.execute(f"PUT 'file://{ndjson_path.as_posix()}' {stage} AUTO_COMPRESS=TRUE")
+        cursor.execute(
+            f"COPY INTO {table_name} FROM {stage} FILES = ('{ndjson_path.name}.gz') "
+            "FILE_FORMAT = (TYPE = JSON) MATCH_BY_COLUMN_NAME = CASE_INSENSITIVE ON_ERROR = CONTINUE PURGE = TRUE"
+        )
+        columns = [desc[0].lower() for desc in cursor.description]
+        written = sum(row[columns.index("rows_loaded")] or 0 for row in cursor.fetchall())
+        return written, len(rows) - written
+    except Exception as e:
+        if _is_session_expired(e):
+            raise
+        print(f"[red]Failed to copy {len(rows)} inference rows into {table_name}: {e}[/red]")
+        return 0, len(rows)
+    finally:
+        ndjson_path.unlink(missing_ok=True)
+
+
+def upload_inference_results_to_snowflake(
+    inference_results, cursor, table_name: str = None, method: str = None, chunk_rows: int = None
+):
+    """
+    Write all predictions of `inference_results` (e.g. one event) in bulk, either with bound multi-row
+    INSERTs (method="insert") or by staging an NDJSON file and running COPY INTO (method="copy").
+    Rows of the same snapshots and endpoint written before are replaced, so the write can be retried as a whole.
+    Returns (rows written, rows failed).
+    """
+    table_name = table_name or snowflake_inference_table()
+    method = method or INFERENCE_WRITE_METHOD
+    if method not in INFERENCE_WRITE_METHODS:
+        raise ValueError(f"Unknown write method '{method}', expected one of {INFERENCE_WRITE_METHODS}")
+    rows, failed = _inference_rows(inference_results)
+    chunk_rows = chunk_rows or INSERT_CHUNK_ROWS
+    with metrics.time("snowflake_seconds", op="delete"):
+        _delete_rows(inference_results, cursor, table_name, chunk_rows)
+    written = 0
+    if rows:
+        with metrics.time("snowflake_seconds", op=method):
+            if method == "copy":
+                written, copy_failed = _copy_rows(rows, cursor, table_name)
+            else:
+                written, copy_failed = _insert_rows(rows, cursor, table_name, chunk_rows)
+        failed += copy_failed
+    metrics.inc("rows_written_total", written, method=method)
+    metrics.inc("rows_failed_total", failed, method=method)
+    if failed:
+        print(f"[red]{failed} inference rows failed to write to {table_name}[/red]")
+    print(f"Wrote {written} inference rows to {table_name}")
+    return written, failed
+
+
+# Best detection of `label` per event. Every construct here supports incremental refresh, so each refresh only
+# reads the micro-partitions of the inference table that changed since the last one.
+DETECTIONS_QUERY = """
+SELECT
+    filename,
+    endpoint_id,
+    label_name,
+    confidence,
+    bboxes,
+    event_id,
+    captured_at AS detected_at
+FROM {source_table}
+WHERE label_name = %(label)s
+QUALIFY ROW_NUMBER() OVER (PARTITION BY event_id ORDER BY confidence DESC) = 1
+"""
+
+
+def create_detections_table(
+    cursor,
+    table_name: str = None,
+    source_table: str = None,
+    label: str = None,
+    target_lag: str = None,
+    warehouse: str = None,
+):
+    """
+    (Re)create the detections dynamic table, clustered on `detected_at`, that Snowflake refreshes incrementally
+    within `target_lag` of new inference rows on `warehouse` (default SNOWFLAKE_WAREHOUSE). Replaces the
+    `robin_detections` view of older setups.
+    """
+    table_name = table_name or DETECTIONS_TABLE
+    source_table = source_table or snowflake_inference_table()
+    warehouse = warehouse or snowflake_config()["warehouse"]
+    if not warehouse:
+        raise ValueError("A dynamic table needs a warehouse to refresh on: set SNOWFLAKE_WAREHOUSE or pass one")
+    *_, name = table_name.split(".")
+    cursor.execute("SHOW VIEWS LIKE %s", (name,))
+    if cursor.fetchall():
+        print(f"Dropping view {table_name}, it is replaced by a dynamic table")
+        cursor.execute(f"DROP VIEW {table_name}")
+    print(
+        f"Creating dynamic table {table_name} over {source_table} (TARGET_LAG = {target_lag or DETECTIONS_TARGET_LAG})"
+    )
+    cursor.execute(
+        f"CREATE OR REPLACE DYNAMIC TABLE {table_name} "
+        f"TARGET_LAG = %(target_lag)s WAREHOUSE = {warehouse} REFRESH_MODE = INCREMENTAL "
+        f"CLUSTER BY (detected_at) AS {DETECTIONS_QUERY.format(source_table=source_table)}",
+        {"target_lag": target_lag or DETECTIONS_TARGET_LAG, "label": label or DETECTIONS_LABEL},
+    )
+
+
+def refresh_detections_table(cursor, table_name: str = None):
+    """Refresh the detections table now instead of waiting for its target lag. Returns the refresh result rows."""
+    table_name = table_name or DETECTIONS_TABLE
+    cursor.execute(f"ALTER DYNAMIC TABLE {table_name} REFRESH")
+    return cursor.fetchall()
+
+
+def latest_detections(cursor, limit: int = 10, table_name: str = None):
+    """The `limit` most recent detections as a list of dicts with lower-case keys."""
+    table_name = table_name or DETECTIONS_TABLE
+    cursor.execute(f"SELECT * FROM {table_name} ORDER BY detected_at DESC LIMIT %s", (int(limit),))
+    columns = [desc[0].lower() for desc in cursor.description]
+    return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+
+def detection_counts(cursor, start, end=None, bucket_minutes: int = 30, table_name: str = None):
+    """
+    Number of detections per `bucket_minutes` bucket (TIME_SLICE) between `start` and `end` (default now),
+    aggregated in Snowflake: [(bucket start, visits)], oldest first, empty buckets omitted.
+    """
+    table_name = table_name or DETECTIONS_TABLE
+    cursor.execute(
+        f"SELECT TIME_SLICE(detected_at, %(bucket)s, 'MINUTE') AS bucket, COUNT(*) AS visits FROM {table_name} "
+        "WHERE detected_at >= %(start)s AND detected_at < COALESCE(%(end)s, CURRENT_TIMESTAMP()) "
+        "GROUP BY bucket ORDER BY bucket",
+        {"bucket": int(bucket_minutes), "start": start, "end": end},
+    )
+    return cursor.fetchall()
+
+
+def detections_since(cursor, since, table_name: str = None):
+    """Detections after `since`, oldest first, as a list of dicts with lower-case keys."""
+    table_name = table_name or DETECTIONS_TABLE
+    cursor.execute(f"SELECT * FROM {table_name} WHERE detected_at > %s ORDER BY detected_at", (since,))
+    columns = [desc[0].lower() for desc in cursor.description]
+    return [dict(zip(columns, row)) for row in cursor.fetchall()]
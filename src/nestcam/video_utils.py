@@ -1,25 +1,241 @@
+import math
 import os
+from dataclasses import dataclass
+from datetime import datetime, timedelta
 from pathlib import Path
 
 import cv2
+import numpy as np
 
+from nestcam.metrics import metrics
 
-def video_to_snapshots(video_path: str, interval_seconds: int = 3, output_dir: str = "data/snapshots"):
-    Path(output_dir).mkdir(parents=True, exist_ok=True)
-    vidcap = cv2.VideoCapture(video_path)
+# "grab" only decodes the frames that are kept, "read" decodes every frame (original behaviour)
+SAMPLING_MODES = ("grab", "read")
+# A URL source that ends more than this many seconds short of its reported length was cut off, not finished
+STREAM_END_TOLERANCE_SECONDS = 1.0
+
+
+@dataclass
+class Snapshot:
+    """A sampled frame kept in memory: decoded image, its JPEG encoding and where it came from."""
+
+    name: str  # filename used on the stage, e.g. <video stem>_<count>.jpg
+    image: np.ndarray  # decoded BGR frame
+    jpeg: bytes
+    frame_index: int
+    timestamp_ms: float
+    path: str = None  # set when the snapshot was also written to disk
+    event_id: str = None  # Ring event the recording belongs to
+    event_time: datetime = None  # when that event started (aware UTC)
+
+    @property
+    def rgb(self):
+        return cv2.cvtColor(self.image, cv2.COLOR_BGR2RGB)
+
+    @property
+    def captured_at(self):
+        """When the frame was taken: event start plus the frame's offset in the recording, None without an event."""
+        if self.event_time is None:
+            return None
+        return self.event_time + timedelta(milliseconds=self.timestamp_ms)
+
+
+def _frame_selector(vidcap, interval_seconds):
+    """
+    Return a callable that tells whether the frame the capture is currently positioned on should be kept.
+    Frames are selected by index when the container reports a usable FPS, otherwise by timestamp (CAP_PROP_POS_MSEC).
+    """
+    fps = vidcap.get(cv2.CAP_PROP_FPS)
+    interval_frames = int(fps * interval_seconds) if math.isfinite(fps) and 0 < fps <= 240 else 0
+    if interval_frames > 0:
+        return lambda: int(vidcap.get(cv2.CAP_PROP_POS_FRAMES)) % interval_frames == 0
+
+    interval_ms = interval_seconds * 1000
+    next_ms = interval_ms
+
+    def keep_by_timestamp():
+        nonlocal next_ms
+        if vidcap.get(cv2.CAP_PROP_POS_MSEC) < next_ms:
+            return False
+        next_ms += interval_ms
+        return True
+
+    return keep_by_timestamp
+
+
+def _check_stream_end(vidcap, source, frames_read, last_ms, frame_count):
+    """
+    Raise IOError if a URL source stopped before its reported frame count or duration, i.e. the fetch broke off
+    mid-recording and FFmpeg just ran out of data. Containers that don't report a length aren't checked.
+    """
     fps = vidcap.get(cv2.CAP_PROP_FPS)
-    interval_frames = int(fps * interval_seconds)
+    if not (math.isfinite(frame_count) and frame_count > 0 and math.isfinite(fps) and fps > 0):
+        return
+    duration_ms = frame_count / fps * 1000
+    if frames_read < frame_count - fps * STREAM_END_TOLERANCE_SECONDS or (
+        last_ms < duration_ms - STREAM_END_TOLERANCE_SECONDS * 1000
+    ):
+        metrics.inc("streams_truncated_total")
+        raise IOError(
+            f"Stream {source} ended after {frames_read} of {frame_count:.0f} frames "
+            f"({last_ms / 1000:.1f}s of {duration_ms / 1000:.1f}s)"
+        )
+
+
+def iter_frames(source: str, interval_seconds: int = 3, mode: str = "grab", jpeg_quality: int = 95, name: str = None):
+    """
+    Yield one in-memory `Snapshot` every `interval_seconds` of `source` as soon as it is decoded. `source` is a local
+    file or an HTTP(S) URL, which FFmpeg fetches progressively while frames are sampled. Snapshots are named
+    `<name>_<count>.jpg`, `name` defaulting to the file stem of `source`.
+    With mode="grab" skipped frames are only demuxed (grab) and never decoded (retrieve).
+    A URL source that ends short of its reported length raises IOError once its last frame is read, so a broken
+    fetch isn't mistaken for a finished recording.
+    """
+    if mode not in SAMPLING_MODES:
+        raise ValueError(f"Unknown sampling mode '{mode}', expected one of {SAMPLING_MODES}")
+    vidcap = cv2.VideoCapture(source)
+    if not vidcap.isOpened():
+        raise IOError(f"Could not open video {source}")
+    keep_frame = _frame_selector(vidcap, interval_seconds)
+    is_url = str(source).startswith(("http://", "https://"))
+    frame_count = vidcap.get(cv2.CAP_PROP_FRAME_COUNT)
+    last_ms = 0.0
     count = 0
-    image_files = []
-    video_stem = Path(video_path).stem
-    success, image = vidcap.read()
-    while success:
-        if int(vidcap.get(cv2.CAP_PROP_POS_FRAMES)) % interval_frames == 0:
-            filename = os.path.join(output_dir, f"{video_stem}_{count}.jpg")
-            cv2.imwrite(filename, image)
-            image_files.append(filename)
-            count += 1
-        success, image = vidcap.read()
-    vidcap.release()
-    os.remove(video_path)
-    return image_files
+    # Counted locally and recorded once per video, not per frame
+    frames_read = frames_decoded = 0
+    name = name or Path(source).stem
+    try:
+        while True:
+            if mode == "grab":
+                if not vidcap.grab():
+                    break
+                frames_read += 1
+                if is_url:
+                    last_ms = vidcap.get(cv2.CAP_PROP_POS_MSEC)
+                if not keep_frame():
+                    continue
+                success, image = vidcap.retrieve()
+                frames_decoded += 1
+            else:
+                success, image = vidcap.read()
+                if not success:
+                    break
+                frames_read += 1
+                frames_decoded += 1
+                if is_url:
+                    last_ms = vidcap.get(cv2.CAP_PROP_POS_MSEC)
+                if not keep_frame():
+                    continue
+            if success:
+                encoded, buffer = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality])
+                if not encoded:
+                    continue
+                yield Snapshot(
+                    name=f"{name}_{count}.jpg",
+                    image=image,
+                    jpeg=buffer.tobytes(),
+                    frame_index=int(vidcap.get(cv2.CAP_PROP_POS_FRAMES)) - 1,
+                    timestamp_ms=vidcap.get(cv2.CAP_PROP_POS_MSEC),
+                )
+                count += 1
+        if is_url:
+            _check_stream_end(vidcap, source, frames_read, last_ms, frame_count)
+    finally:
+        vidcap.release()
+        metrics.inc("frames_read_total", frames_read)
+        metrics.inc("frames_decoded_total", frames_decoded)
+        metrics.inc("snapshots_sampled_total", count)
+
+
+def video_to_frames(
+    video_path: str, interval_seconds: int = 3, mode: str = "grab", jpeg_quality: int = 95, name: str = None
+):
+    """
+    Sample one frame every `interval_seconds` of `video_path` into in-memory `Snapshot`s (named after `name`, see
+    `iter_frames`) and delete the video.
+    """
+    try:
+        return list(iter_frames(video_path, interval_seconds, mode, jpeg_quality, name))
+    finally:
+        os.remove(video_path)
+
+
+def save_snapshots(snapshots, output_dir: str = "data/snapshots"):
+    """Write the JPEG bytes of `snapshots` to `output_dir` (for debugging) and return the file paths."""
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    for snapshot in snapshots:
+        snapshot.path = os.path.join(output_dir, snapshot.name)
+        Path(snapshot.path).write_bytes(snapshot.jpeg)
+    return [snapshot.path for snapshot in snapshots]
+
+
+def video_to_snapshots(
+    video_path: str, interval_seconds: int = 3, output_dir: str = "data/snapshots", mode: str = "grab"
+):
+    """Save one frame every `interval_seconds` of `video_path` as a JPEG in `output_dir` and delete the video."""
+    return save_snapshots(video_to_frames(video_path, interval_seconds, mode), output_dir)
+
+
+PREFILTER_METHODS = ("diff", "phash")
+# Gray levels a downscaled pixel has to change by to count as changed (above sensor noise and compression artifacts)
+PIXEL_CHANGE_LEVELS = 12
+# The "diff" signature (64x64) is compared in PREFILTER_GRID x PREFILTER_GRID blocks, and a frame changed as much as
+# its most changed block. A small subject then counts as fully as a large one: in a 640x360 frame a block is 80x45
+# pixels, so a 40x40 bird arriving changes about half of one block, but less than 1% of the whole frame.
+PREFILTER_GRID = 8
+
+
+def _frame_signature(image, method: str):
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    if method == "phash":
+        # Perceptual hash: sign of the low-frequency DCT coefficients against their median
+        dct = cv2.dct(np.float32(cv2.resize(gray, (32, 32), interpolation=cv2.INTER_AREA)))[:8, :8]
+        return dct > np.median(dct)
+    return cv2.resize(gray, (64, 64), interpolation=cv2.INTER_AREA).astype(np.int16)
+
+
+def perceptual_hash(image):
+    """64-bit perceptual hash of a BGR frame as a hex string (the "phash" signature of `iter_distinct`)."""
+    return np.packbits(_frame_signature(image, "phash")).tobytes().hex()
+
+
+def _frame_change(previous, current, method: str):
+    """
+    Change between two frame signatures as a fraction in [0, 1]: for "diff" the fraction of changed pixels in the
+    most changed block, for "phash" the fraction of differing hash bits (a whole-frame measure).
+    """
+    if method == "phash":
+        return np.count_nonzero(previous != current) / previous.size
+    changed = np.abs(current - previous) > PIXEL_CHANGE_LEVELS
+    block_height, block_width = changed.shape[0] // PREFILTER_GRID, changed.shape[1] // PREFILTER_GRID
+    blocks = changed.reshape(PREFILTER_GRID, block_height, PREFILTER_GRID, block_width).mean(axis=(1, 3))
+    return float(blocks.max())
+
+
+def iter_distinct(snapshots, threshold: float = 0.05, method: str = "diff", stats: dict = None):
+    """
+    Yield the snapshots that changed at least `threshold` from the last kept one, comparing downscaled grayscale frames
+    (method="diff", fraction of changed pixels in the most changed block) or perceptual hashes (method="phash",
+    fraction of differing bits, which only sees changes to the whole scene).
+    The first snapshot is always kept. Skipped snapshots are counted in `stats["dropped"]`.
+    """
+    if method not in PREFILTER_METHODS:
+        raise ValueError(f"Unknown prefilter method '{method}', expected one of {PREFILTER_METHODS}")
+    stats = stats if stats is not None else {}
+    stats.setdefault("dropped", 0)
+    last_signature = None
+    for snapshot in snapshots:
+        signature = _frame_signature(snapshot.image, method)
+        if last_signature is not None and _frame_change(last_signature, signature, method) < threshold:
+            stats["dropped"] += 1
+            metrics.inc("snapshots_dropped_total")
+            continue
+        last_signature = signature
+        yield snapshot
+
+
+def drop_near_duplicates(snapshots, threshold: float = 0.05, method: str = "diff"):
+    """Snapshots without near-duplicates (see `iter_distinct`). Returns (kept snapshots, number dropped)."""
+    stats = {}
+    kept = list(iter_distinct(snapshots, threshold, method, stats))
+    return kept, stats["dropped"]
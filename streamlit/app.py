@@ -1,141 +1,208 @@
 import json
-import os
-from pathlib import Path
+from datetime import datetime, timedelta, timezone
 
 import pandas as pd
-from dotenv import load_dotenv
 from PIL import Image, ImageDraw
 
 import streamlit as st
+from nestcam.config import snowflake_image_stage
+from nestcam.image_cache import StageImageCache
+from nestcam.snowflake_utils import SnowflakePool, detection_counts, detections_since, latest_detections
 
 st.set_page_config(layout="wide")
 
-load_dotenv()
-
-
-# Load and validate environment variables
-SNOWFLAKE_CONFIG = {
-    "user": os.getenv("SNOWFLAKE_USER"),
-    "password": os.getenv("SNOWFLAKE_PASSWORD"),
-    "account": os.getenv("SNOWFLAKE_ACCOUNT"),
-    "warehouse": os.getenv("SNOWFLAKE_WAREHOUSE"),
-    "database": os.getenv("SNOWFLAKE_DATABASE"),
-    "schema": os.getenv("SNOWFLAKE_SCHEMA"),
-    "authenticator": os.getenv("SNOWFLAKE_AUTHENTICATOR"),
-}
-
-STAGE_NAME = os.getenv("SNOWFLAKE_IMAGE_STAGE")
-
-
-def get_snowflake_connection():
-    import snowflake.connector
-
-    if "sf_conn" not in st.session_state or st.session_state.sf_conn is None:
-        conn_args = {k: v for k, v in SNOWFLAKE_CONFIG.items() if v is not None}
-        st.session_state.sf_conn = snowflake.connector.connect(**conn_args)
-    return st.session_state.sf_conn
-
-
-@st.cache_data(ttl=60)
-def load_robin_detections(limit=100):
-    conn = get_snowflake_connection()
-    cur = conn.cursor()
-    cur.execute(f"""
-        SELECT *
-        FROM robin_detections
-        ORDER BY detected_at DESC
-        LIMIT {limit}
-    """)
-    columns = [desc[0] for desc in cur.description]
-    rows = cur.fetchall()
-    cur.close()
-    df = pd.DataFrame(rows, columns=columns)
-    df.columns = [col.lower() for col in df.columns]
+STAGE_NAME = snowflake_image_stage()
+# Detections shown under the latest one
+GALLERY_SIZE = 6
+# History the chart can show (days -> label); buckets grow with the range so the chart stays under MAX_BUCKETS bars
+HISTORY_RANGES = {1: "Last 24 Hours", 7: "Last 7 Days", 30: "Last 30 Days", 90: "Last 90 Days", 365: "Last Year"}
+BUCKET_MINUTES = (30, 60, 180, 360, 720, 1440)
+MAX_BUCKETS = 400
+# The "recent visits" metric window
+RECENT_MINUTES = 30
+# Live mode: seconds between incremental fetches, and how far behind the high-water mark to look again for
+# detections that land in the table late (pipeline latency + the dynamic table's target lag)
+LIVE_REFRESH_SECONDS = 30
+LATE_ARRIVAL_MINUTES = 10
+
+
+@st.cache_resource
+def get_snowflake_pool():
+    # One pool for all sessions and reruns of the app, instead of a connection per browser session
+    return SnowflakePool(size=2)
+
+
+def _bucket_minutes(history_days: int):
+    """Smallest bucket that keeps the chart under MAX_BUCKETS bars, whatever the history range."""
+    for minutes in BUCKET_MINUTES:
+        if history_days * 24 * 60 / minutes <= MAX_BUCKETS:
+            return minutes
+    return BUCKET_MINUTES[-1]
+
+
+def _detections_frame(rows):
+    df = pd.DataFrame(rows, columns=None if rows else ["filename", "bboxes", "event_id", "detected_at"])
+    df["detected_at"] = pd.to_datetime(df["detected_at"], utc=True)
     return df
 
 
-def download_image_from_stage(stage_name: str, image_path: str):
-    conn = get_snowflake_connection()
-    cur = conn.cursor()
-    local_dir = Path("./data")
-    local_dir.mkdir(exist_ok=True)
-    local_path = local_dir / "latest_detection.jpg"
+@st.cache_data(ttl=60)
+def load_dashboard(history_days: int):
+    """
+    Everything both columns show, aggregated in Snowflake: latest detections, visits per bucket and the detections
+    of the last RECENT_MINUTES (few rows, also the starting point of live mode).
+    """
+    now = datetime.now(timezone.utc)
+    bucket_minutes = _bucket_minutes(history_days)
+
+    def query(cur):
+        latest = _detections_frame(latest_detections(cur, GALLERY_SIZE + 1))
+        counts = pd.DataFrame(
+            detection_counts(cur, now - timedelta(days=history_days), now, bucket_minutes=bucket_minutes),
+            columns=["interval", "visits"],
+        )
+        recent = _detections_frame(detections_since(cur, now - timedelta(minutes=RECENT_MINUTES)))
+        return latest, counts, recent
+
+    latest, counts, recent = get_snowflake_pool().run(query)
+    counts["interval"] = pd.to_datetime(counts["interval"], utc=True)
+    return {
+        "latest": latest,
+        "counts": counts,
+        "recent": recent,
+        "bucket_minutes": bucket_minutes,
+        "loaded_at": pd.Timestamp(now),
+    }
+
+
+def update_live_dashboard(history_days: int):
+    """
+    Session-local copy of the dashboard kept current by fetching only detections newer than the high-water mark
+    (minus LATE_ARRIVAL_MINUTES, de-duplicated by event) and merging them in.
+    """
+    live = st.session_state.get("live")
+    if live is None or live["history_days"] != history_days:
+        live = {**load_dashboard(history_days), "history_days": history_days}
+        live["high_water_mark"] = live["loaded_at"]
+        st.session_state.live = live
+        return live
+
+    since = live["high_water_mark"] - pd.Timedelta(minutes=LATE_ARRIVAL_MINUTES)
+    fetched = _detections_frame(get_snowflake_pool().run(detections_since, since.to_pydatetime()))
+    new = fetched[~fetched["event_id"].isin(live["recent"]["event_id"])]
+    now = pd.Timestamp.now(tz="UTC")
+    if not new.empty:
+        live["high_water_mark"] = max(live["high_water_mark"], new["detected_at"].max())
+        live["latest"] = (
+            pd.concat([live["latest"], new]).sort_values("detected_at", ascending=False).head(GALLERY_SIZE + 1)
+        )
+        # Same buckets as TIME_SLICE, which also aligns them to the epoch
+        added = new["detected_at"].dt.floor(f"{live['bucket_minutes']}min").value_counts()
+        counts = live["counts"].set_index("interval")["visits"].add(added, fill_value=0).astype(int)
+        live["counts"] = counts.rename_axis("interval").reset_index(name="visits").sort_values("interval")
+        live["recent"] = pd.concat([live["recent"], new])
+    # Keep every detection that the next fetch can return again, so it isn't counted twice
+    keep_since = min(now - pd.Timedelta(minutes=RECENT_MINUTES), since)
+    live["recent"] = live["recent"][live["recent"]["detected_at"] >= keep_since]
+    live["counts"] = live["counts"][live["counts"]["interval"] >= now - pd.Timedelta(days=history_days)]
+    return live
+
+
+@st.cache_resource
+def get_image_cache():
+    # Shared by all sessions; images are fetched from the stage once and then read from disk
+    return StageImageCache(get_snowflake_pool(), STAGE_NAME)
+
+
+def _bbox_list(bboxes):
+    bbox_list = json.loads(bboxes) if isinstance(bboxes, str) else bboxes
+    if not bbox_list:
+        return []
+    # A single box is stored as a flat list
+    return bbox_list if isinstance(bbox_list[0], list) else [bbox_list]
+
+
+@st.cache_data(max_entries=64)
+def load_annotated_image(image_path: str, bboxes: str):
+    """Decoded stage image with its bounding boxes drawn, kept in memory across reruns."""
+    local_path = get_image_cache().get(image_path)
+    if local_path is None:
+        return None
+    image = Image.open(local_path).convert("RGB")
     try:
-        full_path = f"@{stage_name}/{image_path}"
-        # Remove existing file if it exists
-        if local_path.exists():
-            local_path.unlink()
-        cur.execute(f"GET {full_path} file://{local_dir}")
-        # Rename the downloaded file to latest_detection.jpg
-        downloaded_file = local_dir / Path(image_path).name
-        if downloaded_file.exists():
-            downloaded_file.rename(local_path)
-            return str(local_path)
-        else:
-            st.error(f"Downloaded file not found: {downloaded_file}")
-            return None
+        draw = ImageDraw.Draw(image)
+        for bbox in _bbox_list(bboxes):
+            draw.rectangle(bbox, outline="red", width=3)
     except Exception as e:
-        st.error(f"Error downloading image: {e}")
-        return None
-    finally:
-        cur.close()
+        st.warning(f"Could not draw bounding box: {e}")
+    return image
+
+
+def render_dashboard(dashboard, history_days: int):
+    # Show latest detection image and plot side by side
+    col1, col2 = st.columns(2)
+
+    with col1:
+        latest_df = dashboard["latest"]
+        if not latest_df.empty and "filename" in latest_df.columns:
+            image_path = latest_df.iloc[0]["filename"]
+            detected_at = latest_df.iloc[0].get("detected_at")
+            bboxes = latest_df.iloc[0].get("bboxes")
+            if image_path:
+                # One GET for the latest image and the gallery below instead of one per image
+                get_image_cache().prefetch(latest_df["filename"].head(GALLERY_SIZE + 1).dropna().tolist())
+                image = load_annotated_image(image_path, json.dumps(_bbox_list(bboxes)) if bboxes is not None else "[]")
+                if image is not None:
+                    st.image(image, caption="Latest Robin Detection")
+                    if detected_at:
+                        st.info(f"🕒 Latest Robin Detection at {detected_at}", icon="🟢")
+                else:
+                    st.warning("Image file not found on the stage.")
+            else:
+                st.info("No image available for the latest detection.")
+            with st.expander("Recent detections"):
+                gallery = latest_df.iloc[1 : GALLERY_SIZE + 1]
+                for column, (_, row) in zip(st.columns(3) * GALLERY_SIZE, gallery.iterrows()):
+                    if not row["filename"]:
+                        continue
+                    bboxes = json.dumps(_bbox_list(row["bboxes"])) if row["bboxes"] is not None else "[]"
+                    image = load_annotated_image(row["filename"], bboxes)
+                    if image is not None:
+                        column.image(image, caption=str(row["detected_at"]))
+        else:
+            st.info("No latest detection found or image column missing.")
+
+    with col2:
+        recent = dashboard["recent"]
+        recent_since = pd.Timestamp.now(tz="UTC") - pd.Timedelta(minutes=RECENT_MINUTES)
+        st.metric(f"Visits in last {RECENT_MINUTES} minutes", int((recent["detected_at"] >= recent_since).sum()))
+        counts = dashboard["counts"]
+        if counts.empty:
+            st.warning("No robin detections found.")
+        else:
+            bucket = dashboard["bucket_minutes"]
+            bucket_label = f"{bucket // 60} Hours" if bucket >= 120 else f"{bucket} Minutes"
+            st.subheader(f"Robin Visits per {bucket_label} ({HISTORY_RANGES[history_days]})")
+            st.bar_chart(data=counts.set_index("interval"), y="visits")
+            if st.checkbox("Show raw data", key="show_raw_data"):
+                st.dataframe(counts)
+                st.dataframe(latest_df)
+
+
+@st.fragment(run_every=LIVE_REFRESH_SECONDS)
+def live_dashboard(history_days: int):
+    # Reruns on its own every LIVE_REFRESH_SECONDS; the rest of the page stays as it is
+    render_dashboard(update_live_dashboard(history_days), history_days)
 
 
 st.title("🐦 Robin Nest")
 
-if st.button("🔄 Refresh"):
-    st.cache_data.clear()
-
-# Show latest detection image and plot side by side
-col1, col2 = st.columns(2)
-
-with col1:
-    latest_df = load_robin_detections()
-    if not latest_df.empty and "filename" in latest_df.columns:
-        image_path = latest_df.iloc[0]["filename"]
-        detected_at = latest_df.iloc[0].get("detected_at")
-        bboxes = latest_df.iloc[0].get("bboxes")
-        if image_path:
-            tmp_file_path = download_image_from_stage(STAGE_NAME, image_path)
-            if tmp_file_path and os.path.exists(tmp_file_path):
-                try:
-                    image = Image.open(tmp_file_path).convert("RGB")
-                    draw = ImageDraw.Draw(image)
-                    if isinstance(bboxes, str):
-                        bbox_list = json.loads(bboxes)
-                    else:
-                        bbox_list = bboxes
-                    if isinstance(bbox_list[0], list):
-                        for bbox in bbox_list:
-                            draw.rectangle(bbox, outline="red", width=3)
-                    else:
-                        draw.rectangle(bbox_list, outline="red", width=3)
-                    st.image(image, caption="Latest Robin Detection")
-                except Exception as e:
-                    st.warning(f"Could not draw bounding box: {e}")
-                    st.image(tmp_file_path, caption="Latest Robin Detection")
-                if detected_at:
-                    st.info(f"🕒 Latest Robin Detection at {detected_at}", icon="🟢")
-            else:
-                st.warning("Image file not found after download.")
-        else:
-            st.info("No image available for the latest detection.")
-    else:
-        st.info("No latest detection found or image column missing.")
-
-with col2:
-    df = load_robin_detections(200)
-    if df.empty:
-        st.warning("No robin detections found.")
-    else:
-        df["detected_at"] = pd.to_datetime(df["detected_at"], utc=True)
-        now = pd.Timestamp.utcnow()
-        last_30_min = now - pd.Timedelta(minutes=30)
-        visits_last_30_min = df[df["detected_at"] >= last_30_min].shape[0]
-        st.metric("Visits in last 30 minutes", visits_last_30_min)
-        df["interval"] = df["detected_at"].dt.floor("30min")
-        freq = df.groupby("interval").size().reset_index(name="visits")
-        st.subheader("Robin Visits per 30 Minutes (All Data)")
-        st.bar_chart(data=freq.set_index("interval"), y="visits")
-        if st.checkbox("Show raw data", key="show_raw_data"):
-            st.dataframe(df)
+history_days = st.selectbox("History", list(HISTORY_RANGES), format_func=HISTORY_RANGES.get, index=1)
+if st.toggle("Live", help=f"Fetch new detections every {LIVE_REFRESH_SECONDS}s instead of reloading everything"):
+    live_dashboard(history_days)
+else:
+    st.session_state.pop("live", None)
+    if st.button("🔄 Refresh"):
+        # Only the queries; cached images never change
+        load_dashboard.clear()
+    render_dashboard(load_dashboard(history_days), history_days)
@@ -0,0 +1,27 @@
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "benchmarks"))
+
+from import_time import COMMANDS, import_times  # noqa: E402
+
+# Multiply the budgets on a slow machine, e.g. NESTCAM_IMPORT_BUDGET_SCALE=2
+BUDGET_SCALE = float(os.getenv("NESTCAM_IMPORT_BUDGET_SCALE", 1))
+
+
+@pytest.mark.parametrize("command", COMMANDS)
+def test_command_skips_unused_backends(command):
+    modules, _, forbidden = COMMANDS[command]
+    loaded = import_times(modules)
+    assert [name for name in forbidden if name in loaded] == []
+
+
+@pytest.mark.parametrize("command", COMMANDS)
+def test_command_import_budget(command):
+    modules, budget_ms, _ = COMMANDS[command]
+    # Fastest of a few runs, so a busy moment on the machine doesn't fail the test
+    total_ms = min(sum(us for us, top_level in import_times(modules).values() if top_level) / 1000 for _ in range(3))
+    assert total_ms <= budget_ms * BUDGET_SCALE